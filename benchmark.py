@@ -0,0 +1,246 @@
+"""
+图片压缩基准测试：在本地生成确定性的合成图片集，测量核心函数的延迟和吞吐量，
+并与保存的基线比较，发现 Pillow 升级或参数调整带来的性能回退
+
+用法：
+    python benchmark.py --save-baseline bench_baseline.json
+    python benchmark.py --baseline bench_baseline.json
+"""
+import argparse
+import hashlib
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from queue import Queue
+
+import PIL
+from PIL import Image
+
+from core import (
+    QualityCurveModel, compress_image, compress_to_target_size,
+    estimate_file_size, estimate_folder_size, size_cache,
+)
+
+# 合成图片集：(文件名, 生成方式, 宽, 高)
+CORPUS = [
+    ('photo_noise.jpg', 'noise', 1600, 1200),
+    ('photo_gradient.jpg', 'gradient', 1600, 1200),
+    ('photo_mixed.jpg', 'mixed', 2400, 1600),
+    ('alpha.png', 'alpha', 1024, 768),
+    ('palette.gif', 'palette', 800, 600),
+]
+LARGE_IMAGE = ('large.jpg', 'mixed', 6000, 4000)
+
+# 主要参数组合：(名称, compress_image 参数)
+PARAM_SETS = [
+    ('default', {'quality': 80}),
+    ('low_quality', {'quality': 40}),
+    ('resize_50', {'quality': 80, 'resize_scale': 50}),
+    ('resize_50_fast', {'quality': 80, 'resize_scale': 50, 'resize_method': 'fast'}),
+    ('grayscale', {'quality': 80, 'grayscale': True}),
+    ('reduce_colors', {'quality': 80, 'reduce_colors': True}),
+    ('extreme', {'quality': 80, 'extreme': True}),
+]
+TARGET_RATIO = 0.3
+
+def _noise(rng, width, height, mode='RGB'):
+    """由种子确定的随机像素，不依赖 Pillow 内部的随机数"""
+    channels = len(mode)
+    return Image.frombytes(mode, (width, height), rng.randbytes(width * height * channels))
+
+def _gradient(width, height):
+    """三个方向不同的线性渐变合成的彩色图片"""
+    red = Image.linear_gradient('L').resize((width, height))
+    green = Image.linear_gradient('L').rotate(90).resize((width, height))
+    blue = Image.radial_gradient('L').resize((width, height))
+    return Image.merge('RGB', (red, green, blue))
+
+def make_image(kind, width, height, rng):
+    if kind == 'noise':
+        # 低分辨率噪声放大，接近照片的纹理而不是纯白噪声
+        return _noise(rng, width // 8, height // 8).resize((width, height), Image.BICUBIC)
+    if kind == 'gradient':
+        return _gradient(width, height)
+    if kind == 'mixed':
+        noise = _noise(rng, width // 4, height // 4).resize((width, height), Image.BICUBIC)
+        return Image.blend(_gradient(width, height), noise, 0.35)
+    if kind == 'alpha':
+        img = _gradient(width, height).convert('RGBA')
+        img.putalpha(Image.radial_gradient('L').resize((width, height)))
+        return img
+    if kind == 'palette':
+        img = make_image('mixed', width, height, rng)
+        return img.convert('P', palette=Image.ADAPTIVE, colors=128)
+    raise ValueError(f"未知的图片类型: {kind}")
+
+def generate_corpus(folder, seed=0, large=True):
+    """
+    在 folder 中生成合成图片集，相同的种子和 Pillow 版本生成相同的文件
+    返回图片路径列表
+    """
+    os.makedirs(folder, exist_ok=True)
+    entries = CORPUS + ([LARGE_IMAGE] if large else [])
+    paths = []
+    for index, (name, kind, width, height) in enumerate(entries):
+        path = os.path.join(folder, name)
+        if not os.path.exists(path):
+            img = make_image(kind, width, height, random.Random(seed * 1000 + index))
+            if path.endswith('.jpg'):
+                img.save(path, 'JPEG', quality=95)
+            else:
+                img.save(path)
+        paths.append(path)
+    return paths
+
+def corpus_digest(paths):
+    """图片集内容摘要，基线与当前图片集不同时给出提示"""
+    digest = hashlib.blake2b(digest_size=8)
+    for path in paths:
+        with open(path, 'rb') as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def measure(func, repeat):
+    """运行 repeat 次，返回每次的耗时（秒）"""
+    timings = []
+    for _ in range(repeat):
+        # 每次都清空大小缓存，测量实际的编码开销
+        size_cache.clear()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def summarize(timings, pixels, files):
+    timings = sorted(timings)
+    median = statistics.median(timings)
+    return {
+        'median': median,
+        'min': timings[0],
+        'max': timings[-1],
+        'files_per_second': files / median if median else 0.0,
+        'megapixels_per_second': pixels / median / 1e6 if median else 0.0,
+    }
+
+def image_pixels(path):
+    with Image.open(path) as img:
+        return img.width * img.height
+
+def build_cases(paths, corpus_folder, output_folder):
+    """
+    返回 (用例名, 函数, 处理的像素数, 文件数) 列表
+    """
+    cases = []
+    for path in paths:
+        name = os.path.basename(path)
+        pixels = image_pixels(path)
+        output_path = os.path.join(output_folder, name)
+        for label, params in PARAM_SETS:
+            cases.append((f'compress_image/{name}/{label}',
+                          lambda p=path, o=output_path, kw=params: compress_image(p, o, **kw),
+                          pixels, 1))
+            cases.append((f'estimate_file_size/{name}/{label}',
+                          lambda p=path, kw=params: estimate_file_size(p, **kw),
+                          pixels, 1))
+        target = int(os.path.getsize(path) * TARGET_RATIO)
+        # 每次使用新的曲线模型，测量没有历史数据时的搜索开销
+        cases.append((f'compress_to_target_size/{name}',
+                      lambda p=path, o=output_path, t=target: compress_to_target_size(
+                          p, o, t, curves=QualityCurveModel()),
+                      pixels, 1))
+    total_pixels = sum(image_pixels(path) for path in paths)
+    for label, params in PARAM_SETS[:3]:
+        cases.append((f'estimate_folder_size/{label}',
+                      lambda kw=params: estimate_folder_size(
+                          corpus_folder, kw['quality'], Queue(),
+                          **{k: v for k, v in kw.items() if k != 'quality'}),
+                      total_pixels, len(paths)))
+    return cases
+
+def run_benchmarks(corpus_folder, repeat=3, pattern=None, large=True, seed=0):
+    """
+    生成图片集并运行所有用例，返回结果字典
+    pattern 不为空时只运行名称中包含该字符串的用例
+    """
+    paths = generate_corpus(corpus_folder, seed=seed, large=large)
+    output_folder = tempfile.mkdtemp(prefix='jpg_zip_bench_')
+    results = {}
+    try:
+        for name, func, pixels, files in build_cases(paths, corpus_folder, output_folder):
+            if pattern and pattern not in name:
+                continue
+            func()  # 预热，排除首次导入编解码器的开销
+            results[name] = summarize(measure(func, repeat), pixels, files)
+            print(f"{name:60s} {results[name]['median'] * 1000:9.1f} ms"
+                  f" {results[name]['megapixels_per_second']:8.1f} MP/s", flush=True)
+    finally:
+        shutil.rmtree(output_folder, ignore_errors=True)
+    return {
+        'environment': {
+            'python': platform.python_version(),
+            'pillow': PIL.__version__,
+            'machine': platform.machine(),
+            'cpu_count': os.cpu_count(),
+            'corpus': corpus_digest(paths),
+        },
+        'results': results,
+    }
+
+def compare(current, baseline, threshold=0.15):
+    """
+    比较当前结果与基线的中位耗时，返回超过 threshold 比例的回退列表
+    每项为 (用例名, 基线秒数, 当前秒数, 变化比例)
+    """
+    for key in ('pillow', 'corpus', 'machine'):
+        old, new = baseline['environment'].get(key), current['environment'].get(key)
+        if old != new:
+            print(f"注意：基线的 {key} 为 {old}，当前为 {new}，结果可能不可比")
+    regressions = []
+    for name, result in current['results'].items():
+        base = baseline['results'].get(name)
+        if base is None:
+            continue
+        change = result['median'] / base['median'] - 1 if base['median'] else 0.0
+        if change > threshold:
+            regressions.append((name, base['median'], result['median'], change))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="图片压缩基准测试")
+    parser.add_argument('--corpus', default=os.path.join(tempfile.gettempdir(), 'jpg_zip_corpus'),
+                        help="合成图片集目录，已存在的文件会复用")
+    parser.add_argument('--seed', type=int, default=0, help="图片集随机种子（默认 0）")
+    parser.add_argument('--repeat', type=int, default=3, help="每个用例的重复次数（默认 3）")
+    parser.add_argument('--filter', help="只运行名称中包含该字符串的用例")
+    parser.add_argument('--no-large', action='store_true', help="不生成和测试超大图片")
+    parser.add_argument('--baseline', metavar='FILE', help="与该基线比较，发现回退时返回非零")
+    parser.add_argument('--save-baseline', metavar='FILE', help="把本次结果保存为基线")
+    parser.add_argument('--threshold', type=float, default=0.15,
+                        help="中位耗时增加超过该比例视为回退（默认 0.15）")
+    args = parser.parse_args(argv)
+
+    current = run_benchmarks(args.corpus, repeat=args.repeat, pattern=args.filter,
+                             large=not args.no_large, seed=args.seed)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump(current, f, indent=2)
+        print(f"基线已保存到 {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        for name, old, new, change in regressions:
+            print(f"回退: {name} {old * 1000:.1f} ms -> {new * 1000:.1f} ms (+{change:.0%})")
+        if regressions:
+            return 1
+        print("没有发现性能回退")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,366 @@
+"""
+图片压缩工具命令行入口，不依赖 tkinter，可在无显示环境中批量运行
+每个文件的结果以一行 JSON 输出到标准输出
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+from queue import Queue
+
+from core import (
+    IMAGE_EXTENSIONS, QUANTIZERS, RESIZE_PRESETS, CompressionPlan, compress_image, compress_to_target_size,
+    compress_folder, compress_folder_pipelined, compress_renditions, estimate_file_size, estimate_folder_size,
+    iter_image_files,
+    estimate_folder_size_sampled, folder_palette, size_cache, ProfileSummary,
+    register_profile_hook, unregister_profile_hook,
+)
+
+SIZE_UNITS = {'B': 1, 'KB': 1024, 'MB': 1024 ** 2, 'GB': 1024 ** 3}
+
+def parse_size(text):
+    """
+    解析形如 500KB、1.5MB 或 2048 的大小字符串，返回字节数
+    """
+    value = text.strip().upper()
+    unit = 'B'
+    for name in sorted(SIZE_UNITS, key=len, reverse=True):
+        if value.endswith(name):
+            value, unit = value[:-len(name)].strip(), name
+            break
+    try:
+        size = float(value) * SIZE_UNITS[unit]
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的大小: {text}")
+    if size <= 0:
+        raise argparse.ArgumentTypeError("目标大小必须大于0")
+    return int(size)
+
+RENDITION_FORMATS = {'jpeg': 'JPEG', 'jpg': 'JPEG', 'png': 'PNG', 'webp': 'WEBP', 'auto': 'auto'}
+
+def parse_rendition(text):
+    """
+    解析输出版本规格，如 scale=50,quality=60,format=jpeg,grayscale
+    可用的键：scale、quality、format（jpeg/png/webp/auto）、grayscale、reduce-colors、output
+    """
+    rendition = {}
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        key, _, value = item.partition('=')
+        key = key.strip().lower().replace('-', '_')
+        try:
+            if key in ('scale', 'resize_scale'):
+                rendition['resize_scale'] = int(value)
+            elif key == 'quality':
+                rendition['quality'] = int(value)
+            elif key == 'format':
+                rendition['format'] = RENDITION_FORMATS[value.strip().lower()]
+            elif key in ('grayscale', 'reduce_colors'):
+                rendition[key] = value.strip().lower() not in ('0', 'false', 'no')
+            elif key == 'output':
+                rendition['output'] = value
+            else:
+                raise KeyError(key)
+        except (KeyError, ValueError):
+            raise argparse.ArgumentTypeError(f"无效的输出版本规格: {item}")
+    return rendition
+
+def build_parser():
+    parser = argparse.ArgumentParser(
+        prog='jpg_zip',
+        description="图片压缩工具（命令行模式）")
+    parser.add_argument('input', help="输入图片文件或文件夹")
+    parser.add_argument('-o', '--output',
+                        help="输出路径：文件夹模式为输出目录，单文件模式可为目录或文件名")
+    parser.add_argument('-q', '--quality', type=int, default=80,
+                        help="压缩质量 0-100（默认 80）")
+    parser.add_argument('-s', '--resize-scale', type=int, default=100,
+                        help="缩放比例 10-100（默认 100）")
+    parser.add_argument('--resize-method', choices=sorted(RESIZE_PRESETS), default='balanced',
+                        help="缩放算法：quality 全尺寸解码+LANCZOS，balanced JPEG 草稿解码+LANCZOS，"
+                             "fast JPEG 草稿解码+BILINEAR（默认 balanced）")
+    parser.add_argument('--format', choices=['auto', 'jpeg', 'png', 'webp'],
+                        help="输出格式，auto 同时编码 JPEG/PNG/WebP 并保留最小的结果，"
+                             "默认输出 PNG 的图片只与无损 WebP 比较；指定格式时输出扩展名随实际格式改变"
+                             "（默认按输入扩展名和透明度选择 JPEG 或 PNG，输出文件名不变）")
+    parser.add_argument('--format-budget', type=float, default=0.5,
+                        help="auto 格式时每个文件比较格式的时间预算（秒，默认 0.5）")
+    parser.add_argument('--png-effort', choices=['fast', 'balanced', 'max'], default='max',
+                        help="PNG 压缩力度：fast 最快，balanced 按图片试探压缩级别，"
+                             "max 最高级别（默认 max）")
+    parser.add_argument('--png-budget', type=float,
+                        help="balanced 力度下每个文件 PNG 编码的时间预算（秒），在预算内取最小的结果")
+    parser.add_argument('--grayscale', action='store_true', help="部分灰度处理")
+    parser.add_argument('--reduce-colors', action='store_true', help="减少颜色数量")
+    parser.add_argument('--extreme', action='store_true', help="极限压缩（可能影响质量）")
+    parser.add_argument('--quantizer', choices=sorted(QUANTIZERS), default='mediancut',
+                        help="减色的量化算法：mediancut 中位切分，fastoctree 快速八叉树，"
+                             "libimagequant 需要 Pillow 带有该库，不可用时改用 fastoctree（默认 mediancut）")
+    parser.add_argument('--palette-proxy', type=int, metavar='PIXELS',
+                        help="减色时在缩小到该像素数的副本上生成调色板，如 65536")
+    parser.add_argument('--shared-palette', action='store_true',
+                        help="文件夹模式减色时从抽样文件生成一个共享调色板，所有文件都使用该调色板")
+    parser.add_argument('-t', '--target-size', type=parse_size,
+                        help="每个文件的目标大小，如 200KB、1.5MB")
+    parser.add_argument('-T', '--total-size', type=parse_size,
+                        help="文件夹模式下所有输出文件的总大小上限，如 50MB")
+    parser.add_argument('--weighting', choices=['pixels', 'estimate'], default='pixels',
+                        help="总大小预算的分配依据：像素数或预估压缩大小（默认 pixels）")
+    parser.add_argument('-j', '--workers', type=int,
+                        help="批量模式的工作进程数（默认等于 CPU 核数）")
+    parser.add_argument('--memory-budget', type=parse_size,
+                        help="批量模式的内存预算，如 4GB（默认物理内存的一半）")
+    parser.add_argument('--force', action='store_true',
+                        help="批量模式忽略清单，重新压缩所有文件")
+    parser.add_argument('--no-manifest', action='store_true',
+                        help="批量模式不在输出目录写入清单")
+    parser.add_argument('--dedup', choices=['hardlink', 'copy', 'off'], default='hardlink',
+                        help="批量模式中内容相同的文件只压缩一次，其余副本硬链接或复制结果（默认 hardlink）")
+    parser.add_argument('--pipeline', action='store_true',
+                        help="批量模式使用流水线：预读文件内容、在内存中编码并异步写出，"
+                             "适合网络存储；不支持目标大小、清单和去重")
+    parser.add_argument('--prefetch', type=int, default=8,
+                        help="流水线模式预读的文件数（默认 8）")
+    parser.add_argument('--watch', action='store_true',
+                        help="持续监视输入文件夹，新文件写入完成后立即压缩，按 Ctrl+C 退出")
+    parser.add_argument('--settle', type=float, default=0.25,
+                        help="监视模式中文件大小保持不变多久才视为写入完成（秒，默认 0.25）")
+    parser.add_argument('--poll', type=float, metavar='SECONDS',
+                        help="监视模式不使用 inotify，改为每隔 SECONDS 秒扫描一次")
+    parser.add_argument('--rendition', action='append', type=parse_rendition, metavar='SPEC',
+                        help="生成一个输出版本，可重复指定，如 --rendition scale=50,quality=60 "
+                             "--rendition scale=25,quality=40,format=png；所有版本共用一次解码")
+    parser.add_argument('--cache', metavar='FILE',
+                        help="大小缓存文件，运行前加载、结束后保存，重复预估时复用结果")
+    parser.add_argument('--estimate', action='store_true',
+                        help="只预估压缩后大小，不写出文件")
+    parser.add_argument('--sample-time', type=float,
+                        help="文件夹预估改为抽样模式，限定用时（秒），输出置信区间")
+    parser.add_argument('--sample-scale', type=int, default=100,
+                        help="抽样预估时样本的分辨率比例 10-100（默认 100）")
+    parser.add_argument('--profile-json', metavar='FILE',
+                        help="记录各处理阶段的耗时，结束后把汇总（含 p50/p90/p99）写入 JSON 文件")
+    parser.add_argument('--profile-prom', metavar='FILE',
+                        help="同上，以 Prometheus 文本格式写入，可供 node_exporter textfile 采集")
+    return parser
+
+def emit(record):
+    """以一行 JSON 输出一条结果"""
+    print(json.dumps(record, ensure_ascii=False), flush=True)
+
+def default_output_path(input_path):
+    """与图形界面一致的默认输出路径：输入所在目录下的 compressed_ 前缀"""
+    input_path = os.path.normpath(input_path)
+    return os.path.join(os.path.dirname(input_path),
+                        f"compressed_{os.path.basename(input_path)}")
+
+def run_estimate(args, params):
+    if os.path.isdir(args.input) and args.sample_time:
+        output_queue = Queue()
+        threading.Thread(
+            target=estimate_folder_size_sampled,
+            args=(args.input, args.quality, output_queue),
+            kwargs=dict(params, time_budget=args.sample_time, sample_scale=args.sample_scale),
+            daemon=True).start()
+        while True:
+            size, low, high, finished = output_queue.get()
+            emit({'type': 'estimate', 'input': args.input, 'estimated_size': size,
+                  'low': low, 'high': high, 'final': finished})
+            if finished:
+                return 0 if size > 0 else 1
+    elif os.path.isdir(args.input):
+        output_queue = Queue()
+        estimate_folder_size(args.input, args.quality, output_queue, **params)
+        size = output_queue.get()
+    else:
+        size = estimate_file_size(args.input, args.quality, **params)
+    emit({'type': 'estimate', 'input': args.input, 'estimated_size': size})
+    return 0 if size > 0 else 1
+
+def run_file(args, params):
+    output_path = args.output or default_output_path(args.input)
+    if os.path.isdir(output_path):
+        output_path = os.path.join(
+            output_path, f"compressed_{os.path.basename(args.input)}")
+    record = {
+        'type': 'file',
+        'input': args.input,
+        'output': output_path,
+        'original_size': os.path.getsize(args.input),
+        'compressed_size': 0,
+        'error': None,
+    }
+    details = {}
+    if args.target_size:
+        size, quality = compress_to_target_size(
+            args.input, output_path, args.target_size, details=details, **params)
+        if size:
+            record['quality'] = quality
+            record['over_target'] = size > args.target_size
+        else:
+            record['error'] = quality
+    else:
+        size = compress_image(args.input, output_path, args.quality, details=details, **params)
+        if isinstance(size, tuple):
+            record['error'] = size[1]
+    # 指定格式时输出文件的扩展名随实际格式改变
+    record.update(details)
+    if not record['error']:
+        record['compressed_size'] = size
+    emit(record)
+    return 1 if record['error'] else 0
+
+def run_renditions(args, params):
+    """
+    为单个文件或文件夹内每个文件生成所有输出版本，文件夹模式在输出目录中保持目录结构
+    """
+    for rendition in args.rendition:
+        rendition.setdefault('quality', args.quality)
+    if os.path.isdir(args.input):
+        output_dir = args.output or default_output_path(args.input)
+        files = [(path, os.path.join(output_dir, os.path.relpath(os.path.dirname(path), args.input)))
+                 for path in iter_image_files(args.input, exclude=output_dir)]
+    else:
+        files = [(args.input, args.output or os.path.dirname(args.input))]
+    failed = 0
+    for input_path, output_dir in files:
+        for result in compress_renditions(input_path, args.rendition, output_dir,
+                                          resize_method=params['resize_method'],
+                                          png_effort=args.png_effort,
+                                          png_time_budget=args.png_budget,
+                                          quantizer=args.quantizer,
+                                          palette_proxy_pixels=args.palette_proxy,
+                                          palette=params.get('palette')):
+            failed += bool(result['error'])
+            emit(dict(type='rendition', **result))
+    return 1 if failed else 0
+
+def run_watch(args, params):
+    from watch import watch_folder
+    if args.target_size or args.total_size:
+        emit({'type': 'error', 'input': args.input, 'error': "监视模式不支持目标大小"})
+        return 2
+    output_dir = args.output or default_output_path(args.input)
+    emit({'type': 'watch', 'input': args.input, 'output': output_dir})
+    try:
+        watch_folder(
+            args.input, output_dir, quality=args.quality,
+            settle=args.settle, use_inotify=args.poll is None, poll_interval=args.poll or 1.0,
+            max_workers=args.workers,
+            progress_callback=lambda result: emit(
+                {'type': 'file', **{k: v for k, v in result.items() if k != 'profile'}}),
+            **params)
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+def run_folder(args, params):
+    output_dir = args.output or default_output_path(args.input)
+    if args.pipeline:
+        if args.target_size or args.total_size:
+            emit({'type': 'error', 'input': args.input, 'error': "流水线模式不支持目标大小"})
+            return 2
+        results = compress_folder_pipelined(
+            args.input, output_dir, args.quality,
+            prefetch=args.prefetch, max_workers=args.workers,
+            progress_callback=lambda done, total, result: emit(
+                {'type': 'file', **{k: v for k, v in result.items() if k != 'profile'}}),
+            **params)
+        return summarize_folder(results)
+    results = compress_folder(
+        args.input, output_dir, args.quality,
+        target_bytes=args.target_size, total_bytes=args.total_size,
+        weighting=args.weighting, max_workers=args.workers,
+        memory_budget=args.memory_budget,
+        incremental=not args.force, manifest=not args.no_manifest,
+        dedup=None if args.dedup == 'off' else args.dedup,
+        progress_callback=lambda done, total, result: emit(
+            {'type': 'file', **{k: v for k, v in result.items() if k != 'profile'}}),
+        **params)
+    return summarize_folder(results, args.total_size)
+
+def summarize_folder(results, total_bytes=None):
+    """
+    输出批量压缩的汇总，设置总预算时 over_budget 为输出总大小超出预算的字节数
+    """
+    failed = sum(1 for r in results if r['error'])
+    summary = {
+        'type': 'summary',
+        'files': len(results),
+        'failed': failed,
+        'skipped': sum(1 for r in results if r['skipped']),
+        'passthrough': sum(1 for r in results if r.get('passthrough')),
+        'duplicates': sum(1 for r in results if r.get('duplicate_of')),
+        'duplicate_bytes': sum(r['original_size'] for r in results if r.get('duplicate_of')),
+        'original_size': sum(r['original_size'] for r in results if not r['error']),
+        'compressed_size': sum(r['compressed_size'] for r in results if not r['error']),
+        'over_target': sum(1 for r in results if r.get('over_target')),
+    }
+    if total_bytes:
+        summary['over_budget'] = max(summary['compressed_size'] - total_bytes, 0)
+    emit(summary)
+    return 1 if failed else 0
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    params = {
+        'resize_scale': args.resize_scale,
+        'grayscale': args.grayscale,
+        'reduce_colors': args.reduce_colors,
+        'extreme': args.extreme,
+        'resize_method': args.resize_method,
+    }
+    if args.png_effort != 'max':
+        params['png_effort'] = args.png_effort
+    if args.png_budget is not None:
+        params['png_time_budget'] = args.png_budget
+    if args.quantizer != 'mediancut':
+        params['quantizer'] = args.quantizer
+    if args.palette_proxy:
+        params['palette_proxy_pixels'] = args.palette_proxy
+    if args.format:
+        params['output_format'] = RENDITION_FORMATS[args.format]
+        params['format_time_budget'] = args.format_budget
+    if not os.path.exists(args.input):
+        emit({'type': 'error', 'input': args.input, 'error': "输入路径不存在"})
+        return 2
+    if not os.path.isdir(args.input) and not args.input.lower().endswith(IMAGE_EXTENSIONS):
+        emit({'type': 'error', 'input': args.input, 'error': "不支持的文件格式"})
+        return 2
+
+    if args.shared_palette and os.path.isdir(args.input) and (args.reduce_colors or args.extreme):
+        # 预估和压缩使用同一个调色板
+        params['palette'] = folder_palette(
+            args.input, CompressionPlan(extreme=args.extreme).colors, args.quantizer,
+            exclude=args.output or default_output_path(args.input))
+    if args.cache:
+        size_cache.load(args.cache)
+    summary = None
+    if args.profile_json or args.profile_prom:
+        summary = ProfileSummary()
+        register_profile_hook(summary.records.append)
+    try:
+        if args.estimate:
+            return run_estimate(args, params)
+        if args.rendition:
+            return run_renditions(args, params)
+        if args.watch:
+            if not os.path.isdir(args.input):
+                emit({'type': 'error', 'input': args.input, 'error': "监视模式需要输入文件夹"})
+                return 2
+            return run_watch(args, params)
+        if os.path.isdir(args.input):
+            return run_folder(args, params)
+        return run_file(args, params)
+    finally:
+        if args.cache:
+            size_cache.save(args.cache)
+        if summary is not None:
+            unregister_profile_hook(summary.records.append)
+            if args.profile_json:
+                summary.to_json(args.profile_json)
+            if args.profile_prom:
+                summary.to_prometheus(args.profile_prom)
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,39 +1,1026 @@
-from PIL import Image
+from PIL import Image, JpegImagePlugin, features
+import asyncio
+import io
+import math
+import mmap
 import os
+import random
+import shutil
+import sys
 import threading
 import time
-from queue import Queue
+from queue import Queue, Empty, Full
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, wait, FIRST_COMPLETED
 import functools
+import hashlib
+import json
+from collections import OrderedDict, deque
+from contextlib import contextmanager
 
-def compress_image(input_path, output_path, quality=80, resize_scale=100, 
-                  grayscale=False, reduce_colors=False, extreme=False):
+# 支持处理的图片扩展名
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.gif')
+
+class SizeCache:
     """
-    压缩单个图片文件，增强压缩效果，改进格式处理
+    预估大小和实际输出大小的 LRU 缓存
+    键由文件路径、修改时间、文件大小、类别和完整的压缩参数组成，文件变化后自动失效
+    可选地保存到磁盘，在多次运行之间复用
+    """
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(path, kind, params):
+        stat = os.stat(path)
+        return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size,
+                kind, tuple(sorted(params.items())))
+
+    def get(self, path, kind, params):
+        try:
+            key = self.make_key(path, kind, params)
+        except OSError:
+            return None
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, path, kind, params, value):
+        if self.maxsize <= 0:
+            return
+        try:
+            key = self.make_key(path, kind, params)
+        except OSError:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def load(self, cache_path):
+        """从磁盘加载缓存，文件不存在或损坏时忽略"""
+        try:
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                entries = json.load(f)
+        except (OSError, ValueError):
+            return
+        with self._lock:
+            for path, mtime_ns, size, kind, params, value in entries:
+                key = (path, mtime_ns, size, kind, tuple(tuple(item) for item in params))
+                self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def save(self, cache_path):
+        """保存缓存到磁盘，先写临时文件再替换，避免中途退出留下损坏的文件"""
+        with self._lock:
+            entries = [list(key) + [value] for key, value in self._entries.items()]
+        temp_path = f"{cache_path}.tmp"
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(entries, f, ensure_ascii=False)
+            os.replace(temp_path, cache_path)
+        except OSError as e:
+            print(f"保存缓存 {cache_path} 时出错: {e}", file=sys.stderr)
+
+# 进程内共享的大小缓存
+size_cache = SizeCache()
+
+class SourceReader(io.RawIOBase):
     """
+    只读的原始文件对象，直接从内存映射或字节缓冲区读取，不复制整个文件
+    继承 io.RawIOBase，readline 等方法与普通文件一致；每个读取器有自己的读取位置，
+    多个线程可以同时读取同一个映射。关闭后释放对缓冲区的引用，映射才能关闭
+    """
+    def __init__(self, buffer, name=None):
+        super().__init__()
+        self.name = name
+        self._buffer = buffer
+        self._view = memoryview(buffer)
+        self._position = 0
+
+    def readinto(self, b):
+        data = self._view[self._position:self._position + len(b)]
+        size = len(data)
+        memoryview(b).cast('B')[:size] = data
+        self._position += size
+        return size
+
+    def read(self, size=-1):
+        # 直接切片，不经过 readinto 的中间缓冲区
+        end = len(self._view) if size is None or size < 0 else min(self._position + size, len(self._view))
+        data = self._view[self._position:end].tobytes()
+        self._position = max(end, self._position)
+        return data
+
+    def readall(self):
+        return self.read()
+
+    def readline(self, size=-1):
+        end = self._buffer.find(b'\n', self._position)
+        end = len(self._view) if end < 0 else end + 1
+        if size is not None and size >= 0:
+            end = min(end, self._position + size)
+        return self.read(max(end - self._position, 0))
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += len(self._view)
+        self._position = max(offset, 0)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def __repr__(self):
+        # 错误信息中显示文件路径而不是对象
+        return repr(self.name) if self.name else super().__repr__()
+
+    def close(self):
+        if not self.closed:
+            self._view.release()
+            self._buffer = None
+        super().close()
+
+class SourceMaps:
+    """
+    源文件的只读内存映射，按文件路径、修改时间和大小缓存最近使用的 maxsize 个
+    预估、目标大小搜索和压缩共用同一个映射，反复预估同一个文件时不再打开和读取文件，
+    数据直接来自已缓存的页面
+    每个映射记录正在使用的读取者，被淘汰或丢弃的映射在最后一个读取者归还后立即关闭，
+    不会一直占用文件（Windows 上被映射的文件不能删除或覆盖）
+    maxsize 为 0 时不缓存空闲的映射：同一文件正在使用的映射仍然共用，最后一个读取者归还后立即关闭；
+    批量工作进程中每个文件只处理一次，映射只在一个任务内有效，不会长期占用文件
+    """
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        # id(映射) -> [映射, 读取者数量, 缓存键（已不在缓存中时为 None）]
+        self._users = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, path):
+        """返回文件内容的只读缓冲区并登记一个读取者，用完后调用 release；空文件返回 b''"""
+        stat = os.stat(path)
+        if not stat.st_size:
+            return b''
+        key = (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+        with self._lock:
+            mapping = self._entries.get(key)
+            if mapping is not None:
+                self._entries.move_to_end(key)
+                self._users[id(mapping)][1] += 1
+                return mapping
+        with open(path, 'rb') as f:
+            mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with self._lock:
+            existing = self._entries.get(key)
+            if existing is not None:
+                # 其他线程同时映射了同一个文件，使用已缓存的映射
+                mapping.close()
+                self._entries.move_to_end(key)
+                self._users[id(existing)][1] += 1
+                return existing
+            self._entries[key] = mapping
+            self._users[id(mapping)] = [mapping, 1, key]
+            while self.maxsize > 0 and len(self._entries) > self.maxsize:
+                self._evict(self._entries.popitem(last=False)[1])
+        return mapping
+
+    def release(self, mapping):
+        """归还 acquire 返回的缓冲区，已不在缓存中且没有其他读取者时关闭映射"""
+        with self._lock:
+            entry = self._users.get(id(mapping))
+            if entry is None or entry[0] is not mapping:
+                return  # 空文件
+            entry[1] -= 1
+            if self.maxsize <= 0 and not entry[1] and entry[2] is not None:
+                # 不缓存空闲的映射
+                del self._entries[entry[2]]
+                entry[2] = None
+            self._close_if_idle(entry)
+
+    def _evict(self, mapping):
+        entry = self._users[id(mapping)]
+        entry[2] = None
+        self._close_if_idle(entry)
+
+    def _close_if_idle(self, entry):
+        mapping, readers, key = entry
+        if readers > 0 or key is not None:
+            return
+        del self._users[id(mapping)]
+        try:
+            mapping.close()
+        except BufferError:
+            pass  # 仍有未释放的视图，由垃圾回收关闭
+
+    def discard(self, path):
+        """写入文件之前丢弃它的映射，避免读取到被截断的文件"""
+        path = os.path.abspath(path)
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == path]:
+                self._evict(self._entries.pop(key))
+
+    def clear(self):
+        """丢弃所有映射，正在使用的映射在归还后关闭"""
+        with self._lock:
+            while self._entries:
+                self._evict(self._entries.popitem()[1])
+
+# 进程内共享的源文件映射
+source_maps = SourceMaps()
+
+def _init_batch_worker():
+    """批量压缩工作进程的初始化函数：每个任务各自映射源文件，不缓存，任务结束时关闭映射"""
+    source_maps.maxsize = 0
+    source_maps.clear()
+
+@contextmanager
+def open_source(path):
+    """
+    通过内存映射打开图片，产生 (图片, 文件内容缓冲区)
+    文件大小即缓冲区长度；缓冲区可以传给 CompressionPlan.cannot_shrink 等函数，不必再次读取文件
+    退出时关闭图片和读取器并归还映射，缓冲区不能在 with 块之外使用
+    """
+    source = source_maps.acquire(path)
+    reader = SourceReader(source, path)
     try:
-        with Image.open(input_path) as img:
-            # 确定输出格式
-            output_format = 'JPEG'
-            if input_path.lower().endswith(('.png', '.gif')) or img.mode in ('RGBA', 'LA') or (reduce_colors and extreme):
-                output_format = 'PNG'
-            
-            save_kwargs = {'optimize': True}
-            
-            # 极限压缩选项
-            if extreme:
-                resize_scale = min(resize_scale, 70)  # 最大70%缩放
-                quality = max(quality, 10)  # 最低质量10
-                
-                if not reduce_colors and output_format == 'PNG':
-                    # 强制减少颜色
-                    img = img.convert('P', palette=Image.ADAPTIVE, colors=64)
-                    save_kwargs = {'optimize': True}
-                else:
-                    save_kwargs['quality'] = quality
-            else:
-                save_kwargs['quality'] = quality
-            
-            # 处理透明图片
+        with Image.open(reader) as img:
+            yield img, source
+    finally:
+        reader.close()
+        source_maps.release(source)
+
+# 图形界面持久化缓存的默认位置
+DEFAULT_CACHE_PATH = os.path.join(os.path.expanduser('~'), '.jpg_zip_cache.json')
+
+# 已注册的性能记录回调，每条记录是一个字典
+_profile_hooks = []
+
+def register_profile_hook(hook):
+    """注册性能记录回调，hook(record) 会收到每个阶段的记录"""
+    _profile_hooks.append(hook)
+
+def unregister_profile_hook(hook):
+    """取消注册性能记录回调"""
+    if hook in _profile_hooks:
+        _profile_hooks.remove(hook)
+
+def dispatch_profile_records(records):
+    """把记录（例如批量工作进程返回的记录）转发给已注册的回调"""
+    for record in records:
+        for hook in list(_profile_hooks):
+            hook(record)
+
+class StageProfiler:
+    """
+    记录单个文件各处理阶段的耗时、像素数和输入输出字节数
+    每条记录同时保存在 records 中并转发给已注册的回调
+    """
+    enabled = True
+
+    def __init__(self, path, dispatch=True):
+        self.path = path
+        self.records = []
+        # 工作进程中只收集记录，由主进程统一转发
+        self.dispatch = dispatch
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """计时一个阶段，阶段内可以向返回的字典补充 pixels、bytes_in、bytes_out 等字段"""
+        info = dict(fields)
+        start = time.perf_counter()
+        try:
+            yield info
+        finally:
+            self.record(name, seconds=time.perf_counter() - start, **info)
+
+    def record(self, name, **fields):
+        record = {'file': self.path, 'stage': name}
+        record.update(fields)
+        self.records.append(record)
+        if self.dispatch:
+            dispatch_profile_records([record])
+
+class _NullProfiler:
+    """未启用性能记录时使用，不做任何记录"""
+    enabled = False
+
+    @contextmanager
+    def stage(self, name, **fields):
+        yield {}
+
+    def record(self, name, **fields):
+        pass
+
+NULL_PROFILER = _NullProfiler()
+
+def get_profiler(path, profiler=None):
+    """返回传入的记录器；未传入但注册了回调时新建一个，否则返回空记录器"""
+    if profiler is not None:
+        return profiler
+    if _profile_hooks:
+        return StageProfiler(path)
+    return NULL_PROFILER
+
+def _percentile(sorted_values, fraction):
+    """已排序数据的线性插值百分位数"""
+    if not sorted_values:
+        return 0.0
+    position = (len(sorted_values) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (position - lower)
+
+class ProfileSummary:
+    """
+    汇总批量任务的阶段记录，给出每个阶段的耗时百分位数和数据量
+    可导出为 JSON 或 Prometheus 文本格式
+    """
+    QUANTILES = (0.5, 0.9, 0.99)
+
+    def __init__(self, records=()):
+        self.records = []
+        self.add(records)
+
+    @classmethod
+    def from_results(cls, results):
+        """从 compress_folder 的结果中收集记录"""
+        return cls(record for result in results for record in result.get('profile', ()))
+
+    def add(self, records):
+        self.records.extend(records)
+
+    def stats(self):
+        stages = {}
+        for record in self.records:
+            stages.setdefault(record['stage'], []).append(record)
+        summary = {}
+        for stage, records in stages.items():
+            seconds = sorted(r.get('seconds', 0.0) for r in records)
+            summary[stage] = {
+                'count': len(records),
+                'seconds_total': sum(seconds),
+                'seconds_max': seconds[-1],
+                'pixels': sum(r.get('pixels', 0) for r in records),
+                'bytes_in': sum(r.get('bytes_in', 0) for r in records),
+                'bytes_out': sum(r.get('bytes_out', 0) for r in records),
+            }
+            for q in self.QUANTILES:
+                summary[stage][f'p{int(q * 100)}'] = _percentile(seconds, q)
+        return summary
+
+    def to_json(self, path=None):
+        text = json.dumps(self.stats(), ensure_ascii=False, indent=2)
+        if path:
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write(text)
+        return text
+
+    def to_prometheus(self, path=None):
+        """Prometheus 文本格式，可写入 node_exporter 的 textfile 目录"""
+        lines = [
+            '# HELP jpg_zip_stage_seconds Wall time per compression stage.',
+            '# TYPE jpg_zip_stage_seconds summary',
+        ]
+        stats = self.stats()
+        for stage, item in sorted(stats.items()):
+            for q in self.QUANTILES:
+                lines.append(f'jpg_zip_stage_seconds{{stage="{stage}",quantile="{q}"}} '
+                             f'{item[f"p{int(q * 100)}"]:.6f}')
+            lines.append(f'jpg_zip_stage_seconds_sum{{stage="{stage}"}} {item["seconds_total"]:.6f}')
+            lines.append(f'jpg_zip_stage_seconds_count{{stage="{stage}"}} {item["count"]}')
+        for metric in ('pixels', 'bytes_in', 'bytes_out'):
+            lines.append(f'# TYPE jpg_zip_stage_{metric}_total counter')
+            for stage, item in sorted(stats.items()):
+                lines.append(f'jpg_zip_stage_{metric}_total{{stage="{stage}"}} {item[metric]}')
+        text = '\n'.join(lines) + '\n'
+        if path:
+            # 先写临时文件再替换，避免采集到写了一半的文件
+            temp_path = f"{path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(temp_path, path)
+        return text
+
+class JobCancelled(Exception):
+    """任务被取消时在检查点抛出"""
+
+class CancellationToken:
+    """
+    协作式取消标记，由任务在检查点（阶段开始、文件之间、试探之间）检查
+    """
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise JobCancelled("任务已取消")
+
+def check_cancelled(cancel_token):
+    """cancel_token 可以为空，为空时不做检查"""
+    if cancel_token is not None:
+        cancel_token.raise_if_cancelled()
+
+class JobProfiler(StageProfiler):
+    """
+    任务中使用的记录器：每个阶段开始前检查取消，结束后发出 stage 进度事件
+    """
+    def __init__(self, path, cancel_token, emit):
+        super().__init__(path)
+        self.cancel_token = cancel_token
+        self.emit = emit
+
+    def stage(self, name, **fields):
+        self.cancel_token.raise_if_cancelled()
+        return super().stage(name, **fields)
+
+    def record(self, name, **fields):
+        super().record(name, **fields)
+        self.emit({'type': 'stage', 'file': self.path, 'stage': name})
+
+class JobHandle:
+    """
+    在后台线程中运行 work(cancel_token, emit) 的任务句柄
+    work 通过 emit(event) 发出进度事件，事件放入 events 队列并调用 on_event；
+    cancel() 只设置取消标记，任务在下一个检查点结束
+    """
+    def __init__(self, work, on_event=None):
+        self.token = CancellationToken()
+        self.events = Queue()
+        self.on_event = on_event
+        self._work = work
+        self._result = None
+        self._error = None
+        self._done = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        try:
+            self._result = self._work(self.token, self.emit)
+        except JobCancelled:
+            pass
+        except Exception as e:
+            self._error = e
+            print(f"后台任务出错: {e}", file=sys.stderr)
+        finally:
+            self._done.set()
+            self.emit({'type': 'done', 'cancelled': self.cancelled, 'error': self._error})
+
+    def emit(self, event):
+        self.events.put(event)
+        if self.on_event:
+            self.on_event(event)
+
+    def cancel(self):
+        self.token.cancel()
+
+    @property
+    def cancelled(self):
+        return self.token.cancelled
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """等待任务结束，超时返回 False"""
+        return self._done.wait(timeout)
+
+    def result(self, timeout=None):
+        """
+        返回 work 的返回值；任务出错时抛出原异常，被取消时抛出 JobCancelled
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError("任务尚未完成")
+        if self._error is not None:
+            raise self._error
+        if self.cancelled:
+            raise JobCancelled("任务已取消")
+        return self._result
+
+    def poll_events(self):
+        """取出所有已发出的事件，供界面定时轮询"""
+        events = []
+        while True:
+            try:
+                events.append(self.events.get_nowait())
+            except Empty:
+                return events
+
+def start_job(work, on_event=None):
+    """创建并启动一个任务句柄"""
+    return JobHandle(work, on_event).start()
+
+class JobSlot:
+    """
+    同一时间只保留一个有效任务：提交新任务时取消上一个，
+    例如参数变化后的新预估会取代仍在运行的旧预估
+    """
+    def __init__(self):
+        self.current = None
+        self._lock = threading.Lock()
+
+    def submit(self, work, on_event=None):
+        with self._lock:
+            if self.current is not None:
+                self.current.cancel()
+            self.current = start_job(work, on_event)
+            return self.current
+
+    def cancel(self):
+        with self._lock:
+            if self.current is not None:
+                self.current.cancel()
+
+    def is_current(self, handle):
+        return handle is self.current
+
+# 缩放算法预设：(重采样滤镜, 是否对 JPEG 使用草稿解码)
+# 草稿解码让 libjpeg 在 DCT 域直接解码为 1/2、1/4 或 1/8 尺寸，再用滤镜缩放到目标尺寸
+RESIZE_PRESETS = {
+    'quality': (Image.LANCZOS, False),
+    'balanced': (Image.LANCZOS, True),
+    'fast': (Image.BILINEAR, True),
+}
+
+def prepare_resize(img, resize_scale, resize_method='balanced'):
+    """
+    根据原始尺寸计算缩放后的目标尺寸，必要时对 JPEG 启用草稿解码
+    必须在图片像素被加载之前调用，返回目标尺寸，不需要缩放时返回 None
+    """
+    if resize_scale >= 100:
+        return None
+    new_size = (max(int(img.width * resize_scale / 100), 1),
+                max(int(img.height * resize_scale / 100), 1))
+    resample, use_draft = RESIZE_PRESETS[resize_method]
+    if use_draft and img.format == 'JPEG':
+        # 草稿解码只会缩小到不小于目标尺寸的最大比例
+        img.draft(img.mode, new_size)
+    return new_size
+
+def resize_image(img, new_size, resize_method='balanced'):
+    """缩放到 prepare_resize 计算的目标尺寸"""
+    if new_size is None or img.size == new_size:
+        return img
+    return img.resize(new_size, RESIZE_PRESETS[resize_method][0])
+
+def derive_smaller(img, new_size, resize_method='balanced'):
+    """
+    从已解码的较大图片缩小到 new_size，用于从一个尺寸派生下一个尺寸
+    使用草稿解码的预设先用 reduce 做整数倍的盒式缩小（与 JPEG 草稿解码的效果相当），
+    再按预设算法缩放剩余部分
+    """
+    if RESIZE_PRESETS[resize_method][1] and img.mode in ('RGB', 'RGBA', 'L', 'LA'):
+        factor = min(img.width // new_size[0], img.height // new_size[1])
+        if factor >= 2:
+            img = img.reduce(factor)
+    return resize_image(img, new_size, resize_method)
+
+# libjpeg 的标准量化表（按行排列，只用于求和，与 Pillow 返回的顺序无关）
+STANDARD_LUMINANCE_TABLE = [
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+]
+STANDARD_CHROMINANCE_TABLE = (
+    [17, 18, 24, 47] + [99] * 4 +
+    [18, 21, 26, 66] + [99] * 4 +
+    [24, 26, 56] + [99] * 5 +
+    [47, 66] + [99] * 6 +
+    [99] * 32
+)
+
+def _scaled_table_sum(table, quality):
+    """按 libjpeg 的质量缩放公式计算量化表之和"""
+    scale = 5000 // quality if quality < 50 else 200 - quality * 2
+    return sum(min(max((value * scale + 50) // 100, 1), 255) for value in table)
+
+@functools.lru_cache(maxsize=1)
+def _quality_table_sums():
+    return [(quality,
+             _scaled_table_sum(STANDARD_LUMINANCE_TABLE, quality),
+             _scaled_table_sum(STANDARD_CHROMINANCE_TABLE, quality))
+            for quality in range(1, 101)]
+
+def estimate_jpeg_quality(img):
+    """
+    根据量化表估计 JPEG 的保存质量，只读取文件头，不解码像素
+    与按标准表缩放的各质量比较量化表之和，取最接近的质量；不是 JPEG 时返回 None
+    """
+    tables = getattr(img, 'quantization', None)
+    if img.format != 'JPEG' or not tables:
+        return None
+    luminance = sum(tables[0])
+    chrominance = sum(tables[1]) if len(tables) > 1 else None
+
+    def distance(item):
+        quality, luminance_sum, chrominance_sum = item
+        error = abs(luminance_sum - luminance)
+        if chrominance is not None:
+            error += abs(chrominance_sum - chrominance)
+        return error
+
+    return min(_quality_table_sums(), key=distance)[0]
+
+# libjpeg 默认（未优化）霍夫曼表中亮度 DC、AC 表的码长计数
+STANDARD_HUFFMAN_BITS = {
+    (0, 0): bytes([0, 1, 5, 1, 1, 1, 1, 1, 1, 0, 0, 0, 0, 0, 0, 0]),
+    (1, 0): bytes([0, 2, 1, 3, 3, 2, 4, 3, 5, 5, 4, 4, 0, 0, 1, 0x7d]),
+}
+
+def jpeg_huffman_optimized(source):
+    """
+    读取 JPEG 文件头判断熵编码是否已经优化：渐进式或使用自定义霍夫曼表时返回 True
+    使用默认霍夫曼表的文件即使提高质量重新编码，也可能因优化编码而变小
+    source 为文件路径，或已读入内存或映射到内存的文件内容
+    """
+    if not isinstance(source, (str, os.PathLike)):
+        with SourceReader(source) as reader:
+            return _jpeg_huffman_optimized(reader)
+    with open(source, 'rb') as f:
+        return _jpeg_huffman_optimized(f)
+
+def _jpeg_huffman_optimized(f):
+    if f.read(2) != b'\xff\xd8':
+        return False
+    while True:
+        marker = f.read(2)
+        if len(marker) < 2 or marker[0] != 0xFF:
+            return False
+        if marker[1] in (0xC2, 0xC6, 0xCA, 0xCE):
+            return True  # 渐进式编码
+        if marker[1] == 0xDA:
+            return False  # 到达扫描数据仍未发现自定义表
+        length = int.from_bytes(f.read(2), 'big')
+        segment = f.read(length - 2)
+        if marker[1] != 0xC4:
+            continue
+        # 一个 DHT 段可以包含多张表：1 字节类别/编号，16 字节码长计数，随后是符号
+        position = 0
+        while position + 17 <= len(segment):
+            table_class, table_id = segment[position] >> 4, segment[position] & 0x0F
+            bits = segment[position + 1:position + 17]
+            standard = STANDARD_HUFFMAN_BITS.get((table_class, table_id))
+            if standard is not None and bits != standard:
+                return True
+            position += 17 + sum(bits)
+
+# PNG 压缩力度：fast 只用 zlib 级别 1；max 为最高级别加逐行滤波优化（原有行为）；
+# balanced 在图片中取一段条带试探几个级别，按大小和耗时选择
+PNG_EFFORTS = ('fast', 'balanced', 'max')
+PNG_PROBE_LEVELS = (1, 6, 9)
+# 探测条带的像素数和段数，条带由几段均匀分布的整行拼成
+PNG_PROBE_PIXELS = 128 * 1024
+PNG_PROBE_BANDS = 4
+# 没有时间预算时，选择大小不超过最小结果这一比例的最低级别
+PNG_LEVEL_TOLERANCE = 0.03
+
+def png_probe_strip(img):
+    """
+    从图片中均匀取几段全分辨率的整行拼成探测条带，图片不比条带大很多时返回 None
+    缩小后的图片会改变相邻像素的相关性，压缩率与原图差别较大，所以取原分辨率的行
+    """
+    width, height = img.size
+    if width * height <= PNG_PROBE_PIXELS * 4:
+        return None
+    band_rows = max(PNG_PROBE_PIXELS // width // PNG_PROBE_BANDS, 8)
+    # 先裁出第一段作为画布，保留调色板和透明信息，再贴入其余各段
+    strip = img.crop((0, 0, width, band_rows * PNG_PROBE_BANDS))
+    for band in range(1, PNG_PROBE_BANDS):
+        top = (height - band_rows) * band // (PNG_PROBE_BANDS - 1)
+        strip.paste(img.crop((0, top, width, top + band_rows)), (0, band * band_rows))
+    return strip
+
+def choose_png_level(img, time_budget=None):
+    """
+    用探测条带试探 PNG_PROBE_LEVELS 中的各个级别，按像素比例外推整幅图片的大小和耗时
+    指定 time_budget（秒）时选择预计耗时在预算内的最小结果，都超出预算时选择最快的级别；
+    否则选择大小不超过最小结果 PNG_LEVEL_TOLERANCE 的最低级别，结果只取决于图片内容
+    图片较小时直接返回最高级别，返回 None 表示使用与 max 相同的设置
+    """
+    strip = png_probe_strip(img)
+    if strip is None:
+        return None
+    scale = img.width * img.height / (strip.width * strip.height)
+    probes = []
+    for level in PNG_PROBE_LEVELS:
+        start = time.perf_counter()
+        size = len(encode_image(strip, 'PNG', {'compress_level': level}))
+        probes.append((level, size, (time.perf_counter() - start) * scale))
+    if time_budget is not None:
+        within = [probe for probe in probes if probe[2] <= time_budget]
+        if not within:
+            return min(probes, key=lambda probe: probe[2])[0]
+        return min(within, key=lambda probe: (probe[1], probe[0]))[0]
+    smallest = min(size for _, size, _ in probes)
+    return next(level for level, size, _ in probes if size <= smallest * (1 + PNG_LEVEL_TOLERANCE))
+
+# 减色使用的量化算法：mediancut 为原有的中位切分，fastoctree 快得多，
+# libimagequant 质量最好但需要 Pillow 编译时带有该库，不可用时改用 fastoctree
+# 与 Image.ADAPTIVE 等一样使用模块级常量，Image.Quantize 枚举在 Pillow 9.1 才加入
+QUANTIZERS = {
+    'mediancut': Image.MEDIANCUT,
+    'fastoctree': Image.FASTOCTREE,
+    'libimagequant': Image.LIBIMAGEQUANT,
+}
+# 共享调色板的抽样文件数和样张总像素数
+PALETTE_SAMPLE_FILES = 16
+PALETTE_PROXY_PIXELS = 256 * 1024
+
+@functools.lru_cache(maxsize=None)
+def quantizer_available(quantizer):
+    return quantizer != 'libimagequant' or bool(features.check_feature('libimagequant'))
+
+def quantize_method(quantizer, mode):
+    """返回 Image.quantize 的算法参数，中位切分不支持 RGBA 图片"""
+    if not quantizer_available(quantizer):
+        quantizer = 'fastoctree'
+    method = QUANTIZERS[quantizer]
+    if mode == 'RGBA' and method == Image.MEDIANCUT:
+        method = Image.FASTOCTREE
+    return method
+
+def palette_image(palette):
+    """由扁平的 RGB 调色板字节生成可传给 Image.quantize 的调色板图片"""
+    image = Image.new('P', (1, 1))
+    image.putpalette(palette)
+    return image
+
+def _proxy(img, max_pixels):
+    """最近邻缩小到不超过 max_pixels 像素，保留原有的颜色值，界面截图的纯色不会被混合"""
+    factor = math.sqrt(img.width * img.height / max_pixels)
+    if factor <= 1:
+        return img
+    return img.resize((max(int(img.width / factor), 1), max(int(img.height / factor), 1)), Image.NEAREST)
+
+def quantize_image(img, colors, quantizer='mediancut', proxy_pixels=None, palette=None):
+    """
+    把图片减色为调色板图片，不做抖动
+    palette 为共享调色板图片时直接映射到该调色板，跳过生成调色板（只支持 RGB 和 L 图片）；
+    proxy_pixels 不为空时在缩小的副本上生成调色板，再把原图映射到该调色板
+    默认参数与原来的 convert('P', palette=ADAPTIVE) 完全相同
+    """
+    if palette is not None and img.mode in ('RGB', 'L'):
+        return img.quantize(palette=palette, dither=Image.NONE)
+    if quantizer == 'mediancut' and not proxy_pixels:
+        return img.convert('P', palette=Image.ADAPTIVE, colors=colors)
+    if img.mode not in ('RGB', 'RGBA'):
+        has_alpha = img.mode in ('LA', 'PA') or 'transparency' in img.info
+        img = img.convert('RGBA' if has_alpha else 'RGB')
+    method = quantize_method(quantizer, img.mode)
+    if not proxy_pixels or img.mode != 'RGB':
+        return img.quantize(colors, method)
+    proxy = _proxy(img, proxy_pixels)
+    if proxy is img:
+        return img.quantize(colors, method)
+    return img.quantize(palette=proxy.quantize(colors, method), dither=Image.NONE)
+
+def build_shared_palette(image_paths, colors=64, quantizer='mediancut', max_pixels=PALETTE_PROXY_PIXELS):
+    """
+    为一组相似的图片（界面截图、商品图等）生成共享调色板，返回扁平的 RGB 调色板字节
+    各图片缩小后的像素拼成一张样张，在样张上生成一次调色板；无法打开的图片被跳过
+    """
+    image_paths = list(image_paths)
+    pixels = []
+    for path in image_paths:
+        try:
+            with Image.open(path) as img:
+                share = max_pixels // len(image_paths)
+                factor = math.sqrt(img.width * img.height / share)
+                if factor > 1:
+                    img.draft('RGB', (int(img.width / factor), int(img.height / factor)))
+                pixels.append(_proxy(img.convert('RGB'), share).tobytes())
+        except Exception as e:
+            print(f"读取 {path} 生成调色板时出错: {e}", file=sys.stderr)
+    if not pixels:
+        return None
+    data = b''.join(pixels)
+    # 量化与像素的排列无关，拼成一列即可
+    sample = Image.frombytes('RGB', (1, len(data) // 3), data)
+    palette = sample.quantize(colors, quantize_method(quantizer, 'RGB'))
+    return bytes(palette.getpalette()[:colors * 3])
+
+def folder_palette(folder_path, colors=64, quantizer='mediancut', exclude=None):
+    """从文件夹中按路径排序均匀抽取 PALETTE_SAMPLE_FILES 个文件生成共享调色板"""
+    paths = sorted(iter_image_files(folder_path, exclude=exclude))
+    if not paths:
+        return None
+    sample = paths[::max(len(paths) // PALETTE_SAMPLE_FILES, 1)][:PALETTE_SAMPLE_FILES]
+    return build_shared_palette(sample, colors, quantizer)
+
+class CompressionPlan:
+    """
+    由压缩参数编译得到的处理计划
+    压缩、预估和目标大小搜索都执行同一个计划，保证预估结果与实际输出一致
+    """
+    def __init__(self, quality=80, resize_scale=100, grayscale=False,
+                 reduce_colors=False, extreme=False, resize_method='balanced', output_format=None,
+                 format_time_budget=0.5, png_effort='max', png_time_budget=None,
+                 quantizer='mediancut', palette_proxy_pixels=None, palette=None):
+        # 原始参数，用作缓存键
+        self.params = {
+            'quality': quality,
+            'resize_scale': resize_scale,
+            'grayscale': grayscale,
+            'reduce_colors': reduce_colors,
+            'extreme': extreme,
+            'resize_method': resize_method,
+        }
+        if output_format:
+            # 只在指定格式时加入，保持已保存缓存的键不变
+            self.params['output_format'] = output_format
+        if png_effort != 'max':
+            self.params['png_effort'] = png_effort
+        if png_time_budget is not None:
+            self.params['png_time_budget'] = png_time_budget
+        if quantizer != 'mediancut':
+            self.params['quantizer'] = quantizer
+        if palette_proxy_pixels:
+            self.params['palette_proxy_pixels'] = palette_proxy_pixels
+        if palette:
+            # 缓存键只记录调色板摘要
+            self.params['palette'] = hashlib.blake2b(palette, digest_size=8).hexdigest()
+        # 极限压缩选项：最大70%缩放，最低质量10
+        if extreme:
+            resize_scale = min(resize_scale, 70)
+            quality = max(quality, 10)
+        self.quality = quality
+        self.resize_scale = resize_scale
+        self.grayscale = grayscale
+        self.reduce_colors = reduce_colors
+        self.extreme = extreme
+        self.resize_method = resize_method
+        # 为空时按输入文件和图片模式选择 JPEG 或 PNG；'auto' 时在候选格式中比较，
+        # 在 format_time_budget 秒内完成编码的格式中取最小的结果
+        self.output_format = output_format
+        self.format_time_budget = format_time_budget
+        # PNG 压缩力度，balanced 时每个文件单独试探级别，png_time_budget 为 PNG 编码的时间预算（秒）
+        if png_effort not in PNG_EFFORTS:
+            raise ValueError(f"未知的 PNG 压缩力度: {png_effort}")
+        self.png_effort = png_effort
+        self.png_time_budget = png_time_budget
+        # 减色的量化算法、生成调色板的缩小副本像素数和共享调色板
+        if quantizer not in QUANTIZERS:
+            raise ValueError(f"未知的量化算法: {quantizer}")
+        self.quantizer = quantizer
+        self.palette_proxy_pixels = palette_proxy_pixels
+        self.palette = palette_image(palette) if palette else None
+        self.colors = 32 if extreme else 64
+
+    def clamp_quality(self, quality):
+        """目标大小搜索时对试探质量应用同样的限制"""
+        return max(quality, 10) if self.extreme else quality
+
+    def save_kwargs(self, output_format, quality=None, img=None, lossless=False):
+        """
+        返回保存参数，quality 为空时使用计划中的质量
+        PNG 的 balanced 力度需要传入待编码的图片来试探压缩级别
+        lossless 为真时 WebP 使用无损编码，用于与 PNG 比较
+        """
+        if output_format == 'PNG':
+            return self.png_kwargs(img)
+        quality = self.quality if quality is None else self.clamp_quality(quality)
+        if output_format == 'WEBP':
+            if lossless:
+                return {'lossless': True, 'method': 4}
+            return {'quality': quality, 'method': 4}
+        return {'optimize': True, 'quality': quality}
+
+    def quantize(self, img, colors):
+        """按计划的量化设置减色"""
+        return quantize_image(img, colors, self.quantizer, self.palette_proxy_pixels, self.palette)
+
+    def png_kwargs(self, img=None):
+        """按压缩力度返回 PNG 保存参数"""
+        if self.png_effort == 'fast':
+            return {'compress_level': 1}
+        if self.png_effort == 'balanced' and img is not None:
+            level = choose_png_level(img, self.png_time_budget)
+            if level is not None:
+                return {'compress_level': level}
+        return {'optimize': True, 'compress_level': 9}  # 最高压缩级别
+
+    def encode(self, img, output_format, profiler=NULL_PROFILER, quality=None):
+        """
+        按计划编码到内存，返回 (输出格式, 字节)
+        自动格式时 output_format 是默认格式，与其他候选格式同时编码并取最小的结果
+        """
+        if self.output_format == 'auto':
+            return race_formats(img, self, output_format, profiler, quality)
+        with profiler.stage('encode', format=output_format, pixels=img.width * img.height) as info:
+            data = encode_image(img, output_format, self.save_kwargs(output_format, quality, img))
+            info['bytes_out'] = len(data)
+        return output_format, data
+
+    def cannot_shrink(self, img, input_path, source_data=None):
+        """
+        快速判断重新编码是否不可能让文件变小：JPEG 原样输出为 JPEG（不缩放、不灰度、不减色），
+        原图质量低于目标质量、色度采样与默认的 4:2:0 相同且熵编码已经优化时，重新编码只会变大
+        只读取文件头，应在 apply 之前调用；source_data 为已读入或映射到内存的文件内容时不再读取文件
+        """
+        if (self.resize_scale < 100 or self.reduce_colors
+                or self.output_format not in (None, 'JPEG')
+                or (self.grayscale and img.mode != 'L')
+                or img.mode not in ('RGB', 'L')
+                or not input_path.lower().endswith(('.jpg', '.jpeg'))):
+            return False
+        source_quality = estimate_jpeg_quality(img)
+        if source_quality is None or source_quality >= self.quality:
+            return False
+        if img.mode != 'L' and JpegImagePlugin.get_sampling(img) != 2:
+            return False
+        return jpeg_huffman_optimized(input_path if source_data is None else source_data)
+
+    def compress(self, img, input_path, original_size, profiler=NULL_PROFILER, source_data=None):
+        """
+        对已打开的图片执行完整的计划，返回 (输出字节, 输出格式, 原样复制的原因)
+        无法让文件变小时输出字节为 None，应复制原文件，输出格式为原图格式；不写入任何文件
+        """
+        source_format = img.format
+        if self.cannot_shrink(img, input_path, source_data):
+            return None, source_format, 'source_quality'
+        img, output_format = self.apply(img, input_path, profiler, original_size)
+        output_format, data = self.encode(img, output_format, profiler)
+        if len(data) >= original_size:
+            return None, source_format, 'no_gain'
+        return data, output_format, None
+
+    def default_format(self, img, input_path):
+        """按输入文件和图片模式确定输出格式，'auto' 时为与其他格式比较前的默认格式"""
+        if self.output_format and self.output_format != 'auto':
+            return self.output_format
+        if input_path.lower().endswith(('.png', '.gif')) or img.mode in ('RGBA', 'LA') or (self.reduce_colors and self.extreme):
+            return 'PNG'
+        return 'JPEG'
+
+    def quality_tunable(self, img, input_path):
+        """
+        输出大小是否随质量变化，只需读取图片头
+        PNG 输出（包括减色后改为 PNG 的图片）只有一种编码结果，目标大小搜索对它没有作用
+        """
+        if self.default_format(img, input_path) == 'PNG':
+            return False  # 自动格式时也只与无损 WebP 比较
+        if self.reduce_colors and self.output_format in (None, 'auto') and img.mode in ('RGB', 'RGBA'):
+            return False
+        return True
+
+    def apply(self, img, input_path, profiler=NULL_PROFILER, original_size=None):
+        """
+        对已打开的图片执行格式判断、透明处理、缩放、灰度和减色等变换
+        不会修改传入的图片，返回 (变换后的图片, 输出格式)
+        original_size 为原文件大小，已知时记录性能数据不再读取文件信息
+        """
+        source = img
+        with profiler.stage('decode') as info:
+            new_size = prepare_resize(img, self.resize_scale, self.resize_method)
+            img.load()
+            info['pixels'] = img.width * img.height
+            if profiler.enabled:
+                info['bytes_in'] = os.path.getsize(input_path) if original_size is None else original_size
+        
+        # 确定输出格式
+        output_format = self.default_format(img, input_path)
+        
+        if self.extreme and not self.reduce_colors and output_format == 'PNG':
+            # 强制减少颜色
+            with profiler.stage('quantize', pixels=img.width * img.height):
+                img = self.quantize(img, 64)
+        
+        # 处理透明图片
+        with profiler.stage('alpha', pixels=img.width * img.height):
             if img.mode in ('RGBA', 'LA'):
                 if output_format == 'JPEG':
                     # 转换为RGB，白色背景
@@ -44,139 +1031,1699 @@ def compress_image(input_path, output_path, quality=80, resize_scale=100,
                     img = img.convert('RGBA')
             elif img.mode == 'P' and 'transparency' in img.info:
                 img = img.convert('RGBA' if output_format == 'PNG' else 'RGB')
-            
-            # 应用缩放
-            if resize_scale < 100:
-                new_width = int(img.width * resize_scale / 100)
-                new_height = int(img.height * resize_scale / 100)
-                img = img.resize((new_width, new_height), Image.LANCZOS)
-            
-            # 应用灰度处理
-            if grayscale:
-                if img.mode != 'L':
-                    width, height = img.size
-                    top_half = img.crop((0, 0, width, height//2))
-                    bottom_half = img.crop((0, height//2, width, height))
-                    bottom_half = bottom_half.convert('L')
-                    img = Image.new('RGB', (width, height))
-                    img.paste(top_half, (0, 0))
-                    img.paste(bottom_half, (0, height//2))
-            
-            # 减少颜色数量
-            if reduce_colors and img.mode in ('RGB', 'RGBA'):
-                colors = 32 if extreme else 64
-                img = img.convert('P', palette=Image.ADAPTIVE, colors=colors)
+            elif img.mode not in ENCODABLE_MODES[output_format]:
+                # 指定输出格式时调色板、CMYK 等模式需要先转换为该格式能写入的模式
+                img = img.convert('RGB')
+        
+        # 应用缩放
+        if new_size is not None:
+            with profiler.stage('resize', pixels=new_size[0] * new_size[1]):
+                img = resize_image(img, new_size, self.resize_method)
+        
+        # 应用灰度处理
+        if self.grayscale and img.mode != 'L':
+            with profiler.stage('grayscale', pixels=img.width * img.height):
+                img = partial_grayscale(img, in_place=img is not source)
+        
+        # 减少颜色数量，JPEG 不支持调色板，指定输出 JPEG 时忽略
+        if self.reduce_colors and img.mode in ('RGB', 'RGBA') and self.output_format != 'JPEG':
+            with profiler.stage('quantize', pixels=img.width * img.height):
+                img = self.quantize(img, self.colors)
+            if self.output_format in (None, 'auto'):
                 output_format = 'PNG'
-                save_kwargs = {'optimize': True}
-            
-            # 针对PNG的特殊处理
-            if output_format == 'PNG':
-                if 'quality' in save_kwargs:
-                    del save_kwargs['quality']
-                save_kwargs['compress_level'] = 9  # 最高压缩级别
-            
+        
+        return img, output_format
+
+def partial_grayscale(img, in_place=False):
+    """
+    部分灰度处理：上半部分保留彩色，下半部分转为灰度，输出 RGB 图片
+    只复制和转换下半部分，再原地贴回，避免整幅图片的多次拷贝
+    """
+    if img.mode != 'RGB' or not in_place:
+        img = img.convert('RGB')
+    width, height = img.size
+    box = (0, height // 2, width, height)
+    img.paste(img.crop(box).convert('L'), box)
+    return img
+
+class ScratchBuffers:
+    """
+    可重用的内存编码缓冲区池，预估和目标大小搜索的每次试探都从池中取一个缓冲区
+    缓冲区不截断，只覆盖写入，保留已分配的内存供下一次编码使用；
+    超过 max_bytes 的缓冲区用完后丢弃，池中最多保留 maxsize 个
+    """
+    def __init__(self, maxsize=8, max_bytes=16 * 1024 * 1024):
+        self.maxsize = maxsize
+        self.max_bytes = max_bytes
+        self._free = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def buffer(self):
+        """取出一个定位到开头的缓冲区，写入的有效长度为退出前的 tell()"""
+        with self._lock:
+            buffer = self._free.pop() if self._free else io.BytesIO()
+        buffer.seek(0)
+        try:
+            yield buffer
+        finally:
+            if buffer.getbuffer().nbytes <= self.max_bytes:
+                with self._lock:
+                    if len(self._free) < self.maxsize:
+                        self._free.append(buffer)
+
+# 进程内共享的编码缓冲区池
+scratch_buffers = ScratchBuffers()
+
+def encode_image(img, output_format, save_kwargs):
+    """
+    将图片编码到池中的缓冲区，返回编码后的字节
+    Image.save 会在图片对象上临时保存编码参数，同一张图片不能在多个线程中同时编码
+    """
+    with scratch_buffers.buffer() as buffer:
+        img.save(buffer, format=output_format, **save_kwargs)
+        with buffer.getbuffer() as view:
+            return bytes(view[:buffer.tell()])
+
+# 自动格式时参与比较的候选格式
+FORMAT_CANDIDATES = ('JPEG', 'PNG', 'WEBP')
+
+@functools.lru_cache(maxsize=None)
+def format_available(output_format):
+    """WebP 需要 Pillow 编译时带有 libwebp"""
+    return output_format != 'WEBP' or features.check('webp')
+
+def candidate_formats(img, default_format):
+    """
+    返回参与比较的候选格式，默认格式排在第一位
+    默认输出 PNG 的图片（透明、调色板、减色或 PNG/GIF 原图）只与无损 WebP 比较，
+    不会被悄悄改为有损编码；其余图片比较 PNG 和有损 WebP
+    """
+    formats = [default_format]
+    for output_format in FORMAT_CANDIDATES:
+        if output_format in formats or not format_available(output_format):
+            continue
+        if output_format == 'JPEG' and (default_format == 'PNG' or img.mode not in ('RGB', 'L')):
+            continue
+        formats.append(output_format)
+    return formats
+
+# 格式比较使用的线程池，按进程创建，批量压缩 fork 出的工作进程会重新创建
+_race_pool = None
+_race_pool_pid = None
+_race_pool_lock = threading.Lock()
+
+def _format_race_pool():
+    global _race_pool, _race_pool_pid
+    with _race_pool_lock:
+        if _race_pool is None or _race_pool_pid != os.getpid():
+            _race_pool = ThreadPoolExecutor(max_workers=len(FORMAT_CANDIDATES))
+            _race_pool_pid = os.getpid()
+        return _race_pool
+
+class _SizeLimitExceeded(Exception):
+    """格式比较中某个格式的输出已经超过当前最小结果"""
+
+class _BoundedBuffer(io.BytesIO):
+    """
+    写入超过 limit[0] 字节时中止编码；limit 由其他线程在得到更小的结果时降低
+    PNG 等逐块写出的编码器因此可以提前结束，不必完整编码注定落选的格式
+    """
+    def __init__(self, limit):
+        super().__init__()
+        self.limit = limit
+
+    def write(self, data):
+        if self.tell() + len(data) > self.limit[0]:
+            raise _SizeLimitExceeded()
+        return super().write(data)
+
+def race_formats(img, plan, default_format, profiler=NULL_PROFILER, quality=None):
+    """
+    同时把已变换好的图片编码为各候选格式，返回 (最小的格式, 字节)
+    只比较 plan.format_time_budget 秒内完成的格式，超时的编码被丢弃，
+    输出已超过当前最小结果的编码提前中止；默认格式总会等到完成，保证有结果
+    """
+    formats = candidate_formats(img, default_format)
+    lossless = default_format == 'PNG'
+    # 当前最小结果的大小，各线程共享
+    limit = [math.inf]
+
+    def encode(output_format, image):
+        with profiler.stage('encode', format=output_format, pixels=image.width * image.height) as info:
+            kwargs = plan.save_kwargs(output_format, quality, image, lossless)
+            if output_format == default_format:
+                data = encode_image(image, output_format, kwargs)
+            else:
+                buffer = _BoundedBuffer(limit)
+                image.save(buffer, format=output_format, **kwargs)
+                data = buffer.getvalue()
+            info['bytes_out'] = len(data)
+        limit[0] = min(limit[0], len(data))
+        return data
+
+    pool = _format_race_pool()
+    # 除默认格式外都在副本上编码，避免多个线程同时保存同一个图片对象
+    futures = {pool.submit(encode, output_format, img if i == 0 else img.copy()): output_format
+               for i, output_format in enumerate(formats)}
+    default_future = next(iter(futures))
+    wait(futures, timeout=plan.format_time_budget)
+    best_format, best_data = default_format, default_future.result()
+    for future, output_format in futures.items():
+        if future is default_future:
+            continue
+        if not future.done():
+            future.cancel()
+            continue
+        if future.exception() is None and len(future.result()) < len(best_data):
+            best_format, best_data = output_format, future.result()
+    return best_format, best_data
+
+# 各输出格式的编码器能直接写入的图片模式，其他模式先转换为 RGB（透明图片单独处理）
+ENCODABLE_MODES = {
+    'JPEG': ('RGB', 'L', 'CMYK'),
+    'PNG': ('1', 'L', 'LA', 'I', 'I;16', 'I;16B', 'P', 'RGB', 'RGBA'),
+    'WEBP': ('RGB', 'RGBA'),
+}
+
+# 各输出格式对应的文件扩展名
+FORMAT_EXTENSIONS = {'JPEG': '.jpg', 'PNG': '.png', 'WEBP': '.webp'}
+FORMAT_EXTENSION_ALIASES = {'JPEG': ('.jpg', '.jpeg'), 'PNG': ('.png',), 'WEBP': ('.webp',)}
+
+def format_output_path(output_path, output_format):
+    """
+    把输出路径的扩展名改为输出格式的扩展名，扩展名已经对应该格式（如 .jpeg）或格式不在
+    FORMAT_EXTENSIONS 中（如原样复制的 GIF）时不变
+    """
+    if output_path is None or output_format not in FORMAT_EXTENSIONS:
+        return output_path
+    root, ext = os.path.splitext(output_path)
+    if ext.lower() in FORMAT_EXTENSION_ALIASES[output_format]:
+        return output_path
+    return root + FORMAT_EXTENSIONS[output_format]
+
+def pass_through(input_path, output_path, profiler=NULL_PROFILER, reason='no_gain'):
+    """
+    重新编码无法让文件变小时直接复制原文件，保证输出不会大于输入，返回原文件大小
+    output_path 为空时只返回大小
+    """
+    size = os.path.getsize(input_path)
+    with profiler.stage('passthrough', reason=reason, bytes_in=size, bytes_out=size):
+        if output_path is not None and os.path.abspath(input_path) != os.path.abspath(output_path):
+            shutil.copyfile(input_path, output_path)
+    return size
+
+def compress_image(input_path, output_path, quality=80, resize_scale=100, 
+                  grayscale=False, reduce_colors=False, extreme=False,
+                  resize_method='balanced', output_format=None, format_time_budget=0.5,
+                  png_effort='max', png_time_budget=None, quantizer='mediancut',
+                  palette_proxy_pixels=None, palette=None, profiler=None, details=None):
+    """
+    压缩单个图片文件，增强压缩效果，改进格式处理
+    output_format 可指定 'JPEG'、'PNG'、'WEBP'，为 'auto' 时比较各格式取最小的结果，
+    指定格式时输出路径的扩展名改为实际写出的格式（原样复制时为原图格式）
+    details 为字典时写入实际的输出路径 'output' 和输出格式 'format'
+    png_effort 为 PNG 压缩力度：'fast'、'balanced'（试探级别，可用 png_time_budget 限定编码秒数）或 'max'
+    减色时 quantizer 选择 'mediancut'、'fastoctree' 或 'libimagequant'，palette_proxy_pixels 不为空时
+    在缩小到该像素数的副本上生成调色板，palette 为 build_shared_palette 生成的共享调色板
+    原图质量已低于目标质量，或重新编码后不比原文件小时，直接复制原文件
+    传入 StageProfiler 或注册了回调时记录各阶段耗时
+    """
+    profiler = get_profiler(input_path, profiler)
+    try:
+        with open_source(input_path) as (img, source):
+            plan = CompressionPlan(
+                quality,
+                resize_scale=resize_scale,
+                grayscale=grayscale,
+                reduce_colors=reduce_colors,
+                extreme=extreme,
+                resize_method=resize_method,
+                output_format=output_format,
+                format_time_budget=format_time_budget,
+                png_effort=png_effort,
+                png_time_budget=png_time_budget,
+                quantizer=quantizer,
+                palette_proxy_pixels=palette_proxy_pixels,
+                palette=palette)
+            original_size = len(source)
+            data, written_format, reason = plan.compress(img, input_path, original_size, profiler, source)
+        if output_format:
+            output_path = format_output_path(output_path, written_format)
+        if details is not None:
+            details.update(output=output_path, format=written_format)
+        # 输出可能覆盖输入文件，先丢弃它的映射
+        source_maps.discard(output_path)
+        
+        if data is None:
+            size = pass_through(input_path, output_path, profiler, reason)
+        else:
             # 保存图片
-            img.save(output_path, format=output_format, **save_kwargs)
-            
-            return os.path.getsize(output_path)
+            with profiler.stage('write', bytes_out=len(data)):
+                with open(output_path, 'wb') as f:
+                    f.write(data)
+            size = len(data)
+        
+        size_cache.put(input_path, 'output', plan.params, size)
+        return size
+    except JobCancelled:
+        raise
     except Exception as e:
-        print(f"处理 {input_path} 时出错: {e}")
+        print(f"处理 {input_path} 时出错: {e}", file=sys.stderr)
+        profiler.record('error', error=str(e))
         # 这里不直接显示错误，而是返回错误信息
         return 0, str(e)
 
-def estimate_file_size(file_path, quality, resize_scale=100, grayscale=False, reduce_colors=False, extreme=False):
+def rendition_output_path(input_path, output_dir, rendition, output_format):
+    """
+    规格中没有指定 output 时的默认输出路径：<文件名>_s<缩放比例>_q<质量>[_gray][_colors][_auto]<扩展名>
+    灰度、减色和自动格式各加一个后缀，只有这些选项不同的版本不会写到同一个文件
+    没有指定格式时保留原扩展名，与 compress_image 的输出一致
+    """
+    if rendition.get('output'):
+        return rendition['output']
+    stem, ext = os.path.splitext(os.path.basename(input_path))
+    if rendition.get('format'):
+        ext = FORMAT_EXTENSIONS[output_format]
+    name = f"{stem}_s{rendition.get('resize_scale', 100)}_q{rendition.get('quality', 80)}"
+    if rendition.get('grayscale'):
+        name += '_gray'
+    if rendition.get('reduce_colors'):
+        name += '_colors'
+    if rendition.get('format') == 'auto':
+        name += '_auto'
+    return os.path.join(output_dir or os.path.dirname(input_path), name + ext)
+
+def _rendition_path_key(input_path, output_dir, rendition):
+    """
+    编码前就能确定的输出路径，自动格式的扩展名要编码后才知道，用格式名代替
+    相同的键一定写到同一个文件
+    """
+    output_format = rendition.get('format')
+    if output_format == 'auto':
+        return rendition_output_path(input_path, output_dir, dict(rendition, format=None), None), 'auto'
+    return rendition_output_path(input_path, output_dir, rendition, output_format), None
+
+def compress_renditions(input_path, renditions, output_dir=None, resize_method='balanced',
+                        png_effort='max', png_time_budget=None, quantizer='mediancut',
+                        palette_proxy_pixels=None, palette=None, max_workers=None, profiler=None):
     """
-    预估单个文件压缩后的大小，考虑高级选项，改进格式处理
+    从一次解码生成多个输出版本，例如原尺寸 q80、50% q60 和 25% q40 的缩略图
+    renditions 中每一项是字典，可包含 resize_scale、quality、grayscale、reduce_colors、
+    format（'JPEG'、'PNG' 或为空自动选择）和 output（输出路径，为空时放在 output_dir 中）
+    原图按最大输出尺寸解码一次，较小的尺寸依次由上一个较大的尺寸缩小得到，
+    各版本的变换和编码在线程池中并行执行
+    输出路径与前面的版本相同时，该版本不编码并在结果中报告错误
+    返回与 renditions 顺序相同的结果字典列表
     """
+    profiler = get_profiler(input_path, profiler)
+    results = [{
+        'input': input_path,
+        'output': None,
+        'resize_scale': rendition.get('resize_scale', 100),
+        'quality': rendition.get('quality', 80),
+        'format': None,
+        'compressed_size': 0,
+        'error': None,
+    } for rendition in renditions]
+    if not renditions:
+        return results
+    # 编码前能确定的重复路径直接报告；其余的（例如未指定格式与指定同一格式）在写出前检查
+    seen = {}
+    for index, (rendition, result) in enumerate(zip(renditions, results)):
+        key = _rendition_path_key(input_path, output_dir, rendition)
+        if key in seen:
+            result['error'] = f"输出路径与第 {seen[key] + 1} 个版本相同"
+        else:
+            seen[key] = index
+    claimed = {}
+    claim_lock = threading.Lock()
+
+    def encode_rendition(index, base):
+        rendition, result = renditions[index], results[index]
+        try:
+            plan = CompressionPlan(
+                result['quality'],
+                grayscale=rendition.get('grayscale', False),
+                reduce_colors=rendition.get('reduce_colors', False),
+                resize_method=resize_method,
+                output_format=rendition.get('format'),
+                png_effort=png_effort,
+                png_time_budget=png_time_budget,
+                quantizer=quantizer,
+                palette_proxy_pixels=palette_proxy_pixels,
+                palette=palette)
+            img, output_format = plan.apply(base, input_path, profiler)
+            if img is base:
+                # 同一尺寸的版本在多个线程中编码，没有变换时使用副本
+                img = base.copy()
+            output_format, data = plan.encode(img, output_format, profiler)
+            output_path = rendition_output_path(input_path, output_dir, rendition, output_format)
+            with claim_lock:
+                other = claimed.setdefault(os.path.abspath(output_path), index)
+            if other != index:
+                result['error'] = f"输出路径与第 {other + 1} 个版本相同: {output_path}"
+                return
+            result.update(output=output_path, format=output_format)
+            if result['resize_scale'] >= 100 and output_format == source_format and len(data) >= original_size:
+                # 与 compress_image 一致，原尺寸同格式的输出不大于原文件
+                result['compressed_size'] = pass_through(input_path, output_path, profiler)
+                return
+            source_maps.discard(output_path)
+            with profiler.stage('write', bytes_out=len(data)):
+                with open(output_path, 'wb') as f:
+                    f.write(data)
+            result['compressed_size'] = len(data)
+        except JobCancelled:
+            raise
+        except Exception as e:
+            print(f"生成 {input_path} 的输出版本时出错: {e}", file=sys.stderr)
+            result['error'] = str(e)
+
     try:
-        with Image.open(file_path) as img:
-            # 确定输出格式
-            output_format = 'JPEG'
-            if file_path.lower().endswith(('.png', '.gif')) or img.mode in ('RGBA', 'LA') or (reduce_colors and extreme):
-                output_format = 'PNG'
-            
-            temp_output = generate_temp_file_path(file_path)
-            save_kwargs = {'optimize': True}
-            
-            # 极限压缩选项
-            if extreme:
-                resize_scale = min(resize_scale, 70)
-                quality = max(quality, 10)
-                
-                if not reduce_colors and output_format == 'PNG':
-                    img = img.convert('P', palette=Image.ADAPTIVE, colors=64)
-                    save_kwargs = {'optimize': True}
-                else:
-                    save_kwargs['quality'] = quality
-            else:
-                save_kwargs['quality'] = quality
-            
-            # 应用缩放
-            if resize_scale < 100:
-                new_width = int(img.width * resize_scale / 100)
-                new_height = int(img.height * resize_scale / 100)
-                img = img.resize((new_width, new_height), Image.LANCZOS)
-            
-            # 应用灰度处理
-            if grayscale:
-                if img.mode != 'L':
-                    width, height = img.size
-                    top_half = img.crop((0, 0, width, height//2))
-                    bottom_half = img.crop((0, height//2, width, height))
-                    bottom_half = bottom_half.convert('L')
-                    img = Image.new('RGB', (width, height))
-                    img.paste(top_half, (0, 0))
-                    img.paste(bottom_half, (0, height//2))
+        if output_dir:
+            os.makedirs(output_dir, exist_ok=True)
+        # 按缩放比例从大到小分组，同一尺寸的版本共用一张缩放后的图片
+        scales = sorted({result['resize_scale'] for result in results}, reverse=True)
+        with open_source(input_path) as (img, source):
+            original_size = len(source)
+            source_format = img.format
+            width, height = img.size
+            with profiler.stage('decode') as info:
+                # 只需解码到最大输出尺寸，JPEG 可以使用草稿解码
+                prepare_resize(img, scales[0], resize_method)
+                img.load()
+                info['pixels'] = img.width * img.height
+                info['bytes_in'] = original_size
+            resized = img
+            if img.mode in ('P', '1') and scales[-1] < 100:
+                # 调色板图片缩放时只能使用最近邻，先转换为真彩色
+                resized = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+            with ThreadPoolExecutor(max_workers=max_workers or min(len(renditions), os.cpu_count() or 1)) as executor:
+                futures = []
+                for scale in scales:
+                    if scale >= 100:
+                        base = img
+                    else:
+                        new_size = (max(int(width * scale / 100), 1), max(int(height * scale / 100), 1))
+                        with profiler.stage('resize', pixels=new_size[0] * new_size[1]):
+                            resized = derive_smaller(resized, new_size, resize_method)
+                        base = resized
+                    # 提交后继续缩小下一个尺寸，与这一尺寸的编码同时进行
+                    futures.extend(executor.submit(encode_rendition, index, base)
+                                   for index, result in enumerate(results)
+                                   if result['resize_scale'] == scale and not result['error'])
+                for future in futures:
+                    future.result()
+    except JobCancelled:
+        raise
+    except Exception as e:
+        print(f"处理 {input_path} 时出错: {e}", file=sys.stderr)
+        profiler.record('error', error=str(e))
+        for result in results:
+            if not result['error'] and not result['compressed_size']:
+                result['error'] = str(e)
+    return results
+
+class QualityCurveModel:
+    """
+    记录质量与文件大小的关系：log(每像素字节数) ≈ 截距 + 斜率 × 质量
+    同一批次中前面文件学到的曲线作为后续文件目标大小搜索的初始猜测
+    """
+    DEFAULT_QUALITY = 75
+    DEFAULT_SLOPE = 0.03
+
+    def __init__(self, smoothing=0.5):
+        self.smoothing = smoothing
+        self._curves = {}
+        self._lock = threading.Lock()
+
+    def predict(self, key, log_target):
+        """返回 (猜测质量, 斜率)，没有历史数据时使用默认值"""
+        with self._lock:
+            curve = self._curves.get(key)
+        if curve is None:
+            return self.DEFAULT_QUALITY, self.DEFAULT_SLOPE
+        intercept, slope = curve
+        return (log_target - intercept) / slope, slope
+
+    def update(self, key, points):
+        """
+        用一次搜索得到的 (质量, log(每像素字节数)) 点更新曲线
+        """
+        if not points:
+            return
+        with self._lock:
+            previous = self._curves.get(key)
+            slope = previous[1] if previous else self.DEFAULT_SLOPE
+            if len(points) >= 2:
+                # 最小二乘拟合斜率
+                mean_q = sum(q for q, _ in points) / len(points)
+                mean_l = sum(l for _, l in points) / len(points)
+                var_q = sum((q - mean_q) ** 2 for q, _ in points)
+                if var_q > 0:
+                    fitted = sum((q - mean_q) * (l - mean_l) for q, l in points) / var_q
+                    if fitted > 0:
+                        slope = fitted
+            intercept = sum(l - slope * q for q, l in points) / len(points)
+            if previous:
+                w = self.smoothing
+                intercept = w * previous[0] + (1 - w) * intercept
+                slope = w * previous[1] + (1 - w) * slope
+            self._curves[key] = (intercept, slope)
+
+def quality_curve_key(output_format, mode, source_bytes, pixels):
+    """
+    质量曲线的分组键：除输出格式和色彩模式外，按原文件每像素比特数每 √2 倍分一档，
+    平滑渐变和噪点照片的曲线相差很大，只有内容复杂度相近的图片共享曲线
+    """
+    bits = source_bytes * 8 / max(pixels, 1)
+    return output_format, mode, round(math.log2(max(bits, 1e-3)) * 2)
+
+# 进程内共享的质量曲线，批量模式下每个工作进程各自积累
+quality_curves = QualityCurveModel()
+
+def search_quality(probe, target_bytes, pixels, curve_key=None, curves=None,
+                   max_iterations=10, tolerance=0.05, low=5, high=100, cached_size=None,
+                   initial_quality=None, min_step=1.0, bracket=2, max_step=25):
+    """
+    基于模型的质量搜索：在 log(大小) 上做割线迭代，同批次内容相近的图片通常 2-3 次编码即可收敛
+    probe(quality) 返回该质量下编码后的字节，cached_size(quality) 可返回已知的大小以跳过编码
+    initial_quality 可指定第一次试探的质量，否则由质量曲线预测
+    历史曲线只决定第一次试探，斜率未经本图片验证前每步最多移动 max_step；
+    区间缩小到 bracket 以内，或在区间两端之间插值预测的质量比已知可行的质量高不到 min_step 时停止；
+    猜测由同一侧的点外推时改为二分，不会因外推而提前停止
+    返回 (质量, 编码字节)，选择不超过目标大小的最高质量，全部超出时返回最小的结果
+    """
+    curves = curves if curves is not None else quality_curves
+    log_pixels = math.log(max(pixels, 1))
+    log_target = math.log(target_bytes)
+    guess, slope = curves.predict(curve_key, log_target - log_pixels)
+    if initial_quality is not None:
+        guess = initial_quality
+    sizes = {}
+    encoded = {}
+    # 迭代瞄准容差窗口的中点，落在窗口内的概率比瞄准上限更高
+    log_aim = math.log(target_bytes * (1 - tolerance / 2))
+
+    for i in range(max_iterations):
+        # 当前区间：fit 为已知不超过目标的最高质量，over 为已知超出目标的最低质量
+        fit = max((q for q, n in sizes.items() if n <= target_bytes), default=low - 1)
+        over = min((q for q, n in sizes.items() if n > target_bytes), default=high + 1)
+        if over - fit <= bracket:
+            break
+        quality = int(round(guess))
+        if not fit < quality < over:
+            quality = min(max(quality, fit + 1), over - 1)
+        if quality in sizes:
+            quality = (fit + over) // 2
+
+        size = cached_size(quality) if cached_size else None
+        if not size:
+            encoded[quality] = probe(quality)
+            size = len(encoded[quality])
+        sizes[quality] = size
+        if target_bytes * (1 - tolerance) <= size <= target_bytes:
+            break
+
+        # 下一个猜测：用离目标最近的两个点估计局部斜率，从最近的点做割线步
+        nearest = sorted(sizes, key=lambda q: abs(math.log(sizes[q]) - log_aim))
+        if len(nearest) >= 2:
+            q1, q2 = nearest[:2]
+            l1, l2 = math.log(sizes[q1]), math.log(sizes[q2])
+            if (l2 - l1) / (q2 - q1) > 0:
+                slope = (l2 - l1) / (q2 - q1)
+        step = (log_aim - math.log(sizes[nearest[0]])) / slope
+        if len(nearest) < 2:
+            # 只有一个点时斜率来自历史曲线或默认值，限制步长避免一次跳到区间另一端
+            step = max(-max_step, min(step, max_step))
+        guess = nearest[0] + step
+
+        fit = max((q for q, n in sizes.items() if n <= target_bytes), default=None)
+        over = min((q for q, n in sizes.items() if n > target_bytes), default=None)
+        if fit is not None and over is not None:
+            # 已有两侧数据：只有在区间两端之间插值得到的猜测才可信，
+            # 由同一侧的点外推或落在区间外时退回二分
+            if {q1, q2} != {fit, over} or not fit < guess < over:
+                guess = (fit + over) / 2
+            elif guess - fit < min_step:
+                break  # 插值的质量与已知可行的质量相差不到 min_step，再编码收益很小
+
+    curves.update(curve_key, sorted(
+        (q, math.log(n) - log_pixels) for q, n in sizes.items()))
+
+    fitting = [q for q, n in sizes.items() if n <= target_bytes]
+    if fitting:
+        best_quality = max(fitting)
+    else:
+        best_quality = min(sizes, key=lambda q: sizes[q])
+    if best_quality not in encoded:
+        encoded[best_quality] = probe(best_quality)
+    return best_quality, encoded[best_quality]
+
+def compress_to_target_size(input_path, output_path, target_bytes, max_iterations=10, tolerance=0.05,
+                            resize_scale=100, grayscale=False, reduce_colors=False, extreme=False,
+                            resize_method='balanced', output_format=None, format_time_budget=0.5,
+                            png_effort='max', png_time_budget=None, quantizer='mediancut',
+                            palette_proxy_pixels=None, palette=None, curves=None, profiler=None,
+                            details=None):
+    """
+    精确压缩到目标文件大小，使用基于质量-大小曲线的插值搜索
+    原图只解码和变换一次，每次试探都编码到内存，最后只写出选中的结果
+    output_path 为空时不写出文件，只返回 (大小, 质量)，多个线程可以同时搜索
+    output_format 为 'auto' 时先按默认质量比较各格式，再在选中的格式中搜索质量；
+    指定格式时输出路径的扩展名改为实际写出的格式，details 与 compress_image 相同
+    """
+    profiler = get_profiler(input_path, profiler)
+
+    def finish(written_format):
+        """返回按实际格式调整后的输出路径"""
+        path = format_output_path(output_path, written_format) if output_format else output_path
+        if details is not None:
+            details.update(output=path, format=written_format)
+        return path
+
+    try:
+        original_size = os.path.getsize(input_path)
+        if original_size <= target_bytes:
+            # 原文件已满足目标大小，直接复制原文件；仍然打开图片，无法识别的文件照常报错
+            with open_source(input_path) as (img, source):
+                source_format = img.format
+            return pass_through(input_path, finish(source_format), profiler, 'under_target'), 100
+
+        with open_source(input_path) as (img, source):
+            plan = CompressionPlan(
+                resize_scale=resize_scale,
+                grayscale=grayscale,
+                reduce_colors=reduce_colors,
+                extreme=extreme,
+                resize_method=resize_method,
+                output_format=output_format,
+                format_time_budget=format_time_budget,
+                png_effort=png_effort,
+                png_time_budget=png_time_budget,
+                quantizer=quantizer,
+                palette_proxy_pixels=palette_proxy_pixels,
+                palette=palette)
+            source_format = img.format
+            img, encode_format = plan.apply(img, input_path, profiler, len(source))
+            img.load()
+            # PNG 以及与 PNG 比较的无损 WebP 只有一种编码结果
+            fixed = encode_format == 'PNG'
+            if plan.output_format == 'auto':
+                encode_format, raced = race_formats(img, plan, encode_format, profiler,
+                                                   QualityCurveModel.DEFAULT_QUALITY)
+            params = dict(plan.params)
+            del params['quality']
             
-            # 减少颜色数量
-            if reduce_colors and img.mode in ('RGB', 'RGBA'):
-                colors = 32 if extreme else 64
-                img = img.convert('P', palette=Image.ADAPTIVE, colors=colors)
-                output_format = 'PNG'
-                save_kwargs = {'optimize': True}
+            def probe(quality):
+                with profiler.stage('encode', format=encode_format, quality=quality,
+                                    pixels=img.width * img.height) as info:
+                    data = encode_image(img, encode_format, plan.save_kwargs(encode_format, quality, img))
+                    info['bytes_out'] = len(data)
+                size_cache.put(input_path, 'output', dict(params, quality=quality), len(data))
+                return data
             
-            # 针对PNG的特殊处理
-            if output_format == 'PNG':
-                if 'quality' in save_kwargs:
-                    del save_kwargs['quality']
-                save_kwargs['compress_level'] = 9
+            def cached_size(quality):
+                return size_cache.get(input_path, 'output', dict(params, quality=quality))
             
-            img.save(temp_output, format=output_format, **save_kwargs)
-            size = os.path.getsize(temp_output)
-            os.remove(temp_output)
+            if fixed and plan.output_format == 'auto':
+                best_quality, best_data = 100, raced
+            elif fixed or encode_format == 'PNG':
+                # PNG 输出与质量参数无关，只需编码一次
+                best_quality = 100
+                best_data = probe(best_quality)
+            else:
+                best_quality, best_data = search_quality(
+                    probe, target_bytes, img.width * img.height,
+                    curve_key=quality_curve_key(encode_format, img.mode, original_size,
+                                                img.width * img.height),
+                    curves=curves,
+                    max_iterations=max_iterations,
+                    tolerance=tolerance,
+                    low=10 if extreme else 5,
+                    cached_size=cached_size,
+                    initial_quality=size_cache.get(
+                        input_path, 'target', dict(params, target_bytes=target_bytes)))
+                size_cache.put(input_path, 'target', dict(params, target_bytes=target_bytes), best_quality)
+    except JobCancelled:
+        raise
+    except Exception as e:
+        print(f"处理 {input_path} 时出错: {e}", file=sys.stderr)
+        profiler.record('error', error=str(e))
+        return 0, str(e)
+    
+    if len(best_data) >= original_size:
+        # 最低质量也不比原文件小
+        return pass_through(input_path, finish(source_format), profiler), 100
+    
+    output_path = finish(encode_format)
+    if output_path is None:
+        return len(best_data), best_quality
+    # 只写出最终结果，输出可能覆盖输入文件，先丢弃它的映射
+    source_maps.discard(output_path)
+    with profiler.stage('write', bytes_out=len(best_data)):
+        with open(output_path, 'wb') as f:
+            f.write(best_data)
+    return len(best_data), best_quality
+
+def estimate_file_size(file_path, quality, resize_scale=100, grayscale=False, reduce_colors=False, extreme=False,
+                       resize_method='balanced', output_format=None, format_time_budget=0.5,
+                       png_effort='max', png_time_budget=None, quantizer='mediancut',
+                       palette_proxy_pixels=None, palette=None, profiler=None):
+    """
+    预估单个文件压缩后的大小，与实际压缩执行同一个处理计划，只在内存中编码
+    与实际压缩一样，无法变小时按原文件大小计算
+    结果与实际输出大小共用缓存，参数回到算过的值时直接返回
+    """
+    plan = CompressionPlan(
+        quality,
+        resize_scale=resize_scale,
+        grayscale=grayscale,
+        reduce_colors=reduce_colors,
+        extreme=extreme,
+        resize_method=resize_method,
+        output_format=output_format,
+        format_time_budget=format_time_budget,
+        png_effort=png_effort,
+        png_time_budget=png_time_budget,
+        quantizer=quantizer,
+        palette_proxy_pixels=palette_proxy_pixels,
+        palette=palette)
+    cached = size_cache.get(file_path, 'output', plan.params)
+    if cached is not None:
+        return cached
+    profiler = get_profiler(file_path, profiler)
+    try:
+        with open_source(file_path) as (img, source):
+            original_size = len(source)
+            if plan.cannot_shrink(img, file_path, source):
+                size_cache.put(file_path, 'output', plan.params, original_size)
+                return original_size
+            img, output_format = plan.apply(img, file_path, profiler, original_size)
+            size = min(len(plan.encode(img, output_format, profiler)[1]), original_size)
+            size_cache.put(file_path, 'output', plan.params, size)
             return size
+    except JobCancelled:
+        raise
     except Exception as e:
-        print(f"预估 {file_path} 大小时出错: {e}")
+        print(f"预估 {file_path} 大小时出错: {e}", file=sys.stderr)
+        profiler.record('error', error=str(e))
         # 这里返回0表示预估失败
         return 0
 
-def estimate_folder_size(folder_path, quality, output_queue, resize_scale=100, grayscale=False, reduce_colors=False, extreme=False):
+def estimate_folder_size(folder_path, quality, output_queue, resize_scale=100, grayscale=False, reduce_colors=False, extreme=False,
+                         resize_method='balanced', output_format=None, format_time_budget=0.5,
+                         png_effort='max', png_time_budget=None, quantizer='mediancut',
+                         palette_proxy_pixels=None, palette=None, cancel_token=None):
     """
     异步预估文件夹内所有图片文件压缩后的总大小，考虑高级选项
+    cancel_token 被取消时直接返回，不向 output_queue 放入结果
     """
     total_size = 0
     try:
-        for root, dirs, files in os.walk(folder_path):
-            for file in files:
-                if file.lower().endswith(('.jpg', '.jpeg', '.png', '.gif')):
-                    file_path = os.path.join(root, file)
-                    size = estimate_file_size(
-                        file_path, quality,
-                        resize_scale=resize_scale,
-                        grayscale=grayscale,
-                        reduce_colors=reduce_colors,
-                        extreme=extreme
-                    )
-                    total_size += size
+        for file_path in iter_image_files(folder_path):
+            check_cancelled(cancel_token)
+            size = estimate_file_size(
+                file_path, quality,
+                resize_scale=resize_scale,
+                grayscale=grayscale,
+                reduce_colors=reduce_colors,
+                extreme=extreme,
+                resize_method=resize_method,
+                output_format=output_format,
+                format_time_budget=format_time_budget,
+                png_effort=png_effort,
+                png_time_budget=png_time_budget,
+                quantizer=quantizer,
+                palette_proxy_pixels=palette_proxy_pixels,
+                palette=palette
+            )
+            total_size += size
+    except JobCancelled:
+        return
     except Exception as e:
-        print(f"预估文件夹 {folder_path} 大小时出错: {e}")
+        print(f"预估文件夹 {folder_path} 大小时出错: {e}", file=sys.stderr)
     output_queue.put(total_size)
 
-def generate_temp_file_path(original_path):
-    """根据原始文件扩展名生成临时文件路径"""
-    temp_timestamp = str(int(time.time() * 1000))
-    ext = os.path.splitext(original_path)[1]
-    return f"temp_compressed_{temp_timestamp}{ext}"
+def iter_image_files(folder_path, exclude=None):
+    """
+    用 os.scandir 逐个生成文件夹内的图片路径，不预先收集完整列表
+    exclude 为需要跳过的目录（例如位于输入目录内的输出目录）
+    """
+    exclude_real = os.path.realpath(exclude) if exclude else None
+    stack = [folder_path]
+    while stack:
+        directory = stack.pop()
+        try:
+            entries = os.scandir(directory)
+        except OSError as e:
+            print(f"读取目录 {directory} 时出错: {e}", file=sys.stderr)
+            continue
+        subdirs = []
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if exclude_real is None or os.path.realpath(entry.path) != exclude_real:
+                            subdirs.append(entry.path)
+                    elif entry.name.lower().endswith(IMAGE_EXTENSIONS) and entry.is_file():
+                        yield entry.path
+                except OSError:
+                    continue
+        # 逆序入栈，使子目录按目录中的顺序处理
+        stack.extend(reversed(subdirs))
+
+class FileDiscovery:
+    """
+    后台线程流式发现图片文件，放入有界队列
+    队列满时发现线程等待，消费者跟不上时内存占用保持稳定
+    """
+    def __init__(self, folder_path, exclude=None, maxsize=1024):
+        self.count = 0
+        self.finished = False
+        self._queue = Queue(maxsize=maxsize)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, args=(folder_path, exclude), daemon=True)
+        self._thread.start()
+
+    def _run(self, folder_path, exclude):
+        try:
+            for path in iter_image_files(folder_path, exclude):
+                if not self._put(path):
+                    return
+        finally:
+            self._put(None)
+
+    def _put(self, item):
+        while not self._stop.is_set():
+            try:
+                self._queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    def get(self, block=True):
+        """取出下一个文件路径；没有可用文件或已全部发现时返回 None"""
+        if self.finished:
+            return None
+        try:
+            path = self._queue.get(block=block)
+        except Empty:
+            return None
+        if path is None:
+            self.finished = True
+            return None
+        self.count += 1
+        return path
+
+    def __iter__(self):
+        while True:
+            path = self.get()
+            if path is None:
+                return
+            yield path
+
+    def close(self):
+        """停止发现线程"""
+        self._stop.set()
+
+def _sample_strata(folder_path):
+    """
+    扫描文件夹并按格式和原始大小分层，返回 [[(路径, 原始大小), ...], ...]
+    """
+    groups = {}
+    for file_path in iter_image_files(folder_path):
+        try:
+            size = os.path.getsize(file_path)
+        except OSError:
+            continue
+        is_jpeg = file_path.lower().endswith(('.jpg', '.jpeg'))
+        groups.setdefault(is_jpeg, []).append((file_path, size))
+    strata = []
+    for files in groups.values():
+        # 每种格式再按原始大小四分位分层
+        files.sort(key=lambda item: item[1])
+        count = min(4, len(files))
+        for i in range(count):
+            stratum = files[i * len(files) // count:(i + 1) * len(files) // count]
+            if stratum:
+                strata.append(stratum)
+    return strata
+
+# 校准样本不足两个时，降分辨率样本换算系数的假定相对误差
+CALIBRATION_REL_ERROR = 0.25
+
+def _ratio_estimate(strata, samples, file_var=0.0, factor_var=0.0, z=1.96):
+    """
+    分层比率估计：每层用样本的 压缩后大小/原始大小 比率外推
+    samples 中每个样本为 (原始大小, 压缩后大小, 是否按原分辨率编码)，降分辨率样本已按校准系数换算；
+    file_var 和 factor_var 为单个文件和平均换算系数的相对方差，计入降分辨率样本的误差
+    返回 (估计总大小, 置信下限, 置信上限)
+    """
+    total = 0.0
+    variance = 0.0
+    # 由降分辨率样本外推的部分，共同受平均换算系数误差的影响
+    scaled_total = 0.0
+    # 样本不足两个的层借用全部样本的相对残差方差
+    all_pairs = [(x, y) for pairs in samples for x, y, _ in pairs]
+    pooled_ratio = (sum(y for _, y in all_pairs) / sum(x for x, _ in all_pairs)
+                    if all_pairs and sum(x for x, _ in all_pairs) else 0)
+    pooled_rel_var = 0.0
+    if len(all_pairs) >= 2:
+        pooled_rel_var = sum((y - pooled_ratio * x) ** 2 / x ** 2 for x, y in all_pairs if x) / (len(all_pairs) - 1)
+    for stratum, pairs in zip(strata, samples):
+        population = len(stratum)
+        stratum_bytes = sum(size for _, size in stratum)
+        n = len(pairs)
+        if n == 0:
+            total += pooled_ratio * stratum_bytes
+            scaled_total += pooled_ratio * stratum_bytes
+            variance += (pooled_rel_var + pooled_ratio ** 2) * stratum_bytes ** 2
+            continue
+        sum_x = sum(x for x, _, _ in pairs)
+        sum_y = sum(y for _, y, _ in pairs)
+        ratio = sum_y / sum_x if sum_x else 0
+        total += ratio * stratum_bytes
+        if sum_y:
+            scaled_share = sum(y for _, y, exact in pairs if not exact) / sum_y
+            scaled_total += ratio * stratum_bytes * scaled_share
+        if n >= population:
+            # 全部文件都已抽样，只剩降分辨率样本各自的换算误差
+            variance += file_var * sum(y ** 2 for _, y, exact in pairs if not exact)
+            continue
+        mean_x = stratum_bytes / population
+        if n >= 2:
+            s2 = sum((y - ratio * x) ** 2 for x, y, _ in pairs) / (n - 1)
+        else:
+            s2 = pooled_rel_var * mean_x ** 2
+        variance += population ** 2 * (1 - n / population) * s2 / n
+    variance += factor_var * scaled_total ** 2
+    margin = z * math.sqrt(variance)
+    return int(total), int(max(total - margin, 0)), int(total + margin)
+
+def estimate_folder_size_sampled(folder_path, quality, output_queue, resize_scale=100, grayscale=False,
+                                 reduce_colors=False, extreme=False, resize_method='balanced', time_budget=1.5,
+                                 sample_scale=100, update_interval=0.2, seed=0, cancel_token=None,
+                                 output_format=None, format_time_budget=0.5,
+                                 png_effort='max', png_time_budget=None, quantizer='mediancut',
+                                 palette_proxy_pixels=None, palette=None):
+    """
+    抽样快速预估文件夹压缩后的总大小
+    按格式和原始大小分层抽样，样本可按 sample_scale 降低分辨率后编码再按校准系数换算，
+    用分层比率估计外推总大小，并不断向 output_queue 放入
+    (预估大小, 置信下限, 置信上限, 是否完成) 以便界面逐步刷新
+    所有文件都抽样后若还有时间，把降分辨率样本逐个改为原分辨率编码，置信区间包含换算系数的误差
+    cancel_token 被取消时在下一个样本前返回，不再放入结果
+    """
+    try:
+        strata = _sample_strata(folder_path)
+        if not strata:
+            output_queue.put((0, 0, 0, True))
+            return
+        rng = random.Random(seed)
+        orders = [rng.sample(range(len(stratum)), len(stratum)) for stratum in strata]
+        # 每个样本为 [原始大小, 降分辨率编码大小, 原分辨率编码大小或 None]
+        samples = [[] for _ in strata]
+
+        # 降分辨率抽样时，用前几个样本同时编码原分辨率来校准大小换算系数
+        effective_scale = min(resize_scale, 70) if extreme else resize_scale
+        probe_scale = effective_scale * sample_scale / 100
+        calibration = []
+        calibration_samples = 3 if sample_scale < 100 else 0
+
+        def estimate(file_path, scale):
+            return estimate_file_size(
+                file_path, quality,
+                resize_scale=scale,
+                grayscale=grayscale,
+                reduce_colors=reduce_colors,
+                extreme=extreme,
+                resize_method=resize_method,
+                output_format=output_format,
+                format_time_budget=format_time_budget,
+                png_effort=png_effort,
+                png_time_budget=png_time_budget,
+                quantizer=quantizer,
+                palette_proxy_pixels=palette_proxy_pixels,
+                palette=palette)
+
+        def calibrate(sample, file_path):
+            sample[2] = estimate(file_path, effective_scale)
+            if sample[1] and sample[2]:
+                calibration.append((sample[1], sample[2]))
+
+        def current():
+            if sample_scale >= 100:
+                factor, file_var = 1.0, 0.0
+            elif calibration:
+                factor = sum(full for _, full in calibration) / sum(probe for probe, _ in calibration)
+                file_var = CALIBRATION_REL_ERROR ** 2
+                if len(calibration) >= 2:
+                    file_var = sum((full / probe / factor - 1) ** 2
+                                   for probe, full in calibration) / (len(calibration) - 1)
+            else:
+                factor, file_var = (100 / sample_scale) ** 2, CALIBRATION_REL_ERROR ** 2
+            scaled = [[(x, y * factor, False) if full is None else (x, full, True)
+                       for x, y, full in pairs] for pairs in samples]
+            return _ratio_estimate(strata, scaled, file_var, file_var / max(len(calibration), 1))
+
+        deadline = time.monotonic() + time_budget
+        last_update = time.monotonic()
+        finished = False
+        while not finished:
+            finished = True
+            # 各层轮流抽样，保证较早的估计也覆盖所有分层
+            for stratum, order, pairs in zip(strata, orders, samples):
+                if len(pairs) >= len(stratum):
+                    continue
+                finished = False
+                check_cancelled(cancel_token)
+                file_path, original_size = stratum[order[len(pairs)]]
+                sample = [original_size, estimate(file_path, probe_scale), None]
+                if sample_scale >= 100:
+                    sample[2] = sample[1]
+                elif calibration_samples and sample[1]:
+                    calibration_samples -= 1
+                    calibrate(sample, file_path)
+                pairs.append(sample)
+            now = time.monotonic()
+            if now >= deadline:
+                break
+            if now - last_update >= update_interval and not finished:
+                output_queue.put(current() + (False,))
+                last_update = now
+        if finished:
+            # 剩余时间用于原分辨率编码，全部完成时预估即为实际大小
+            pending = [(sample, stratum[order[i]][0])
+                       for stratum, order, pairs in zip(strata, orders, samples)
+                       for i, sample in enumerate(pairs) if sample[2] is None]
+            for sample, file_path in pending:
+                if time.monotonic() >= deadline:
+                    break
+                check_cancelled(cancel_token)
+                calibrate(sample, file_path)
+                now = time.monotonic()
+                if now - last_update >= update_interval:
+                    output_queue.put(current() + (False,))
+                    last_update = now
+        output_queue.put(current() + (True,))
+    except JobCancelled:
+        return
+    except Exception as e:
+        print(f"预估文件夹 {folder_path} 大小时出错: {e}", file=sys.stderr)
+        output_queue.put((0, 0, 0, True))
+
+# 各图片模式在 Pillow 内部每像素占用的字节数，未列出的按 4 字节计算
+MODE_BYTES_PER_PIXEL = {'1': 1, 'L': 1, 'P': 1, 'I;16': 2}
+
+def estimate_peak_memory(input_path, plan):
+    """
+    只读取图片头，估计按处理计划压缩该图片时的峰值内存（字节）
+    考虑 JPEG 草稿解码后的实际解码尺寸：解码图和透明合成等中间图按 2.5 份计算，
+    需要缩放时，缩放结果和缩放中间缓冲、灰度、减色按 3 份计算
+    """
+    with Image.open(input_path) as img:
+        width, height = img.size
+        bytes_per_pixel = MODE_BYTES_PER_PIXEL.get(img.mode, 4)
+        is_jpeg = img.format == 'JPEG'
+    scale = min(plan.resize_scale, 100) / 100
+    new_width, new_height = max(int(width * scale), 1), max(int(height * scale), 1)
+    decoded_width, decoded_height = width, height
+    if scale < 1 and is_jpeg and RESIZE_PRESETS[plan.resize_method][1]:
+        # 与 libjpeg 草稿解码一致：选择不小于目标尺寸的最大缩小比例
+        for denominator in (8, 4, 2):
+            if width // denominator >= new_width and height // denominator >= new_height:
+                decoded_width, decoded_height = width // denominator, height // denominator
+                break
+    decoded = decoded_width * decoded_height * bytes_per_pixel
+    resized = 0
+    if (decoded_width, decoded_height) != (new_width, new_height):
+        resized = new_width * new_height * 4
+    return int(decoded * 2.5 + resized * 3)
+
+def default_memory_budget():
+    """默认内存预算：物理内存的一半，无法获取时按 2 GB 计算"""
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 2
+    except (AttributeError, ValueError, OSError):
+        return 2 * 1024 ** 3
+
+# 批量压缩清单的文件名，保存在输出目录中
+MANIFEST_NAME = '.jpg_zip_manifest.jsonl'
+
+def content_digest(data):
+    """计算已读入或映射到内存的文件内容的 BLAKE2b 摘要，与 file_digest 的结果相同"""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """计算文件内容的 BLAKE2b 摘要"""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class BatchManifest:
+    """
+    批量压缩清单，每完成一个文件追加一行 JSON 记录：
+    输入路径、大小、修改时间、内容摘要、压缩参数、输出路径、输出大小和输出格式
+    重新运行时跳过未变化且已用相同参数压缩过的文件，进程中途退出后也能从断点继续
+    """
+    def __init__(self, input_folder, output_folder):
+        self.input_folder = input_folder
+        self.output_folder = output_folder
+        self.path = os.path.join(output_folder, MANIFEST_NAME)
+        self.records = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # 中途退出时最后一行可能不完整
+                    self.records[record['input']] = record
+        except OSError:
+            pass
+        # 压缩旧记录，每个输入只保留最新一条
+        os.makedirs(output_folder, exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            for record in self.records.values():
+                f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        os.replace(temp_path, self.path)
+        self._file = open(self.path, 'a', encoding='utf-8')
+
+    def lookup(self, input_path, settings):
+        """
+        文件未变化、参数相同且输出文件完好时返回上次的记录，否则返回 None
+        修改时间变化但大小相同时比较内容摘要
+        """
+        record = self.records.get(os.path.relpath(input_path, self.input_folder))
+        if record is None or record['settings'] != settings:
+            return None
+        stat = os.stat(input_path)
+        if stat.st_size != record['size']:
+            return None
+        output_path = os.path.join(self.output_folder, record['output'])
+        try:
+            if os.path.getsize(output_path) != record['output_size']:
+                return None
+        except OSError:
+            return None
+        if stat.st_mtime_ns != record['mtime_ns'] and file_digest(input_path) != record['hash']:
+            return None
+        return record
+
+    def append(self, result, settings):
+        """记录一个成功完成的文件，立即写入磁盘"""
+        stat = os.stat(result['input'])
+        record = {
+            'input': os.path.relpath(result['input'], self.input_folder),
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'hash': result['hash'],
+            'settings': settings,
+            'output': os.path.relpath(result['output'], self.output_folder),
+            'output_size': result['compressed_size'],
+        }
+        if result.get('format'):
+            record['format'] = result['format']
+        self.records[record['input']] = record
+        self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+def link_or_copy(source, destination, mode='hardlink'):
+    """
+    把 source 硬链接到 destination，不支持硬链接（如跨文件系统）或 mode 为 'copy' 时复制
+    """
+    if os.path.abspath(source) == os.path.abspath(destination):
+        return
+    if os.path.lexists(destination):
+        os.remove(destination)
+    if mode == 'hardlink':
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass
+    shutil.copyfile(source, destination)
+
+def batch_output_path(input_path, input_folder, output_folder):
+    """批量压缩的输出路径：在输出目录中保持目录结构，文件名加 compressed_ 前缀"""
+    rel_dir = os.path.relpath(os.path.dirname(input_path), input_folder)
+    return os.path.normpath(os.path.join(
+        output_folder, rel_dir, f"compressed_{os.path.basename(input_path)}"))
+
+def _compress_folder_job(job):
+    """
+    批量压缩的工作进程入口，压缩一个文件并返回结果字典
+    digest 为真时（写入清单需要）在结果中加入内容摘要 'hash'，摘要直接取自解码用的映射，不再读取文件
+    """
+    input_path, output_path, params, target_bytes, profile, digest = job
+    profiler = StageProfiler(input_path, dispatch=False) if profile else NULL_PROFILER
+    result = {
+        'input': input_path,
+        'output': output_path,
+        'original_size': 0,
+        'compressed_size': 0,
+        'error': None,
+        'skipped': False,
+    }
+    source = None
+    try:
+        result['original_size'] = os.path.getsize(input_path)
+        if digest:
+            # 压缩期间持有映射，compress_image 打开同一文件时共用这个映射
+            source = source_maps.acquire(input_path)
+            result['hash'] = content_digest(source)
+        os.makedirs(os.path.dirname(output_path), exist_ok=True)
+        if os.path.exists(output_path) and os.stat(output_path).st_nlink > 1:
+            # 上次运行可能把这个输出硬链接给了重复文件，先删除，避免改写共享的内容
+            os.remove(output_path)
+        details = {}
+        if target_bytes:
+            params = dict(params)
+            del params['quality']
+            size, quality = compress_to_target_size(
+                input_path, output_path, target_bytes, profiler=profiler, details=details, **params)
+            if size:
+                result['quality'] = quality
+                # PNG 输出或最低质量仍然超出时无法达到目标大小
+                result['over_target'] = size > target_bytes
+            else:
+                result['error'] = quality
+        else:
+            size = compress_image(input_path, output_path, profiler=profiler, details=details, **params)
+            if isinstance(size, tuple):
+                result['error'] = size[1]
+        # 指定格式时输出路径的扩展名可能改为实际格式
+        result.update(details)
+        if not result['error']:
+            result['compressed_size'] = size
+            # 无法变小的文件按原样复制，输出与原文件大小相同
+            result['passthrough'] = size == result['original_size']
+    except Exception as e:
+        result['error'] = str(e)
+        profiler.record('error', error=str(e))
+    finally:
+        if source is not None:
+            source_maps.release(source)
+    if profile:
+        result['profile'] = profiler.records
+    return result
+
+def _budget_weight_job(job):
+    """
+    计算总预算分配权重的工作进程入口，返回 (权重, 固定大小)
+    weighting 为 'pixels' 时按像素数，为 'estimate' 时按当前参数下的预估压缩大小
+    输出大小与质量无关的文件权重为 0，固定大小为预估的输出大小，其余文件固定大小为 None
+    """
+    input_path, params, weighting = job
+    params = dict(params)
+    quality = params.pop('quality')
+    try:
+        with Image.open(input_path) as img:
+            pixels = img.width * img.height
+            tunable = CompressionPlan(quality, **params).quality_tunable(img, input_path)
+        if not tunable:
+            return 0, estimate_file_size(input_path, quality, **params)
+        if weighting == 'estimate':
+            return estimate_file_size(input_path, quality, **params), None
+        return pixels, None
+    except Exception:
+        return 0, None
+
+def folder_params(quality=80, resize_scale=100, grayscale=False, reduce_colors=False, extreme=False,
+                  resize_method='balanced', output_format=None, format_time_budget=0.5,
+                  png_effort='max', png_time_budget=None, quantizer='mediancut',
+                  palette_proxy_pixels=None, palette=None):
+    """
+    批量压缩传给每个文件的压缩参数，后来增加的参数只在不是默认值时加入，已有清单中的设置仍然匹配
+    """
+    params = {
+        'quality': quality,
+        'resize_scale': resize_scale,
+        'grayscale': grayscale,
+        'reduce_colors': reduce_colors,
+        'extreme': extreme,
+        'resize_method': resize_method,
+    }
+    if output_format:
+        params['output_format'] = output_format
+        params['format_time_budget'] = format_time_budget
+    if png_effort != 'max':
+        params['png_effort'] = png_effort
+    if png_time_budget is not None:
+        params['png_time_budget'] = png_time_budget
+    if quantizer != 'mediancut':
+        params['quantizer'] = quantizer
+    if palette_proxy_pixels:
+        params['palette_proxy_pixels'] = palette_proxy_pixels
+    if palette:
+        params['palette'] = palette
+    return params
+
+def batch_settings(params, target_bytes=None, total_bytes=None, weighting='pixels'):
+    """清单中比较的设置：压缩参数加上目标大小设置，调色板只记录摘要"""
+    settings = dict(params, target_bytes=target_bytes, total_bytes=total_bytes)
+    if params.get('palette'):
+        settings['palette'] = CompressionPlan(palette=params['palette']).params['palette']
+    if total_bytes:
+        settings['weighting'] = weighting
+    return settings
+
+def compress_folder(input_folder, output_folder, quality=80, resize_scale=100,
+                    grayscale=False, reduce_colors=False, extreme=False,
+                    resize_method='balanced', output_format=None, format_time_budget=0.5,
+                    png_effort='max', png_time_budget=None, quantizer='mediancut',
+                    palette_proxy_pixels=None, palette=None, shared_palette=False,
+                    target_bytes=None, total_bytes=None, weighting='pixels',
+                    max_workers=None, memory_budget=None, incremental=True, manifest=True,
+                    dedup='hardlink', progress_callback=None, profile=False, cancel_token=None):
+    """
+    使用多进程批量压缩文件夹内的所有图片，输出目录保持与输入目录相同的结构
+    文件由后台线程流式发现，第一个文件发现后即开始压缩
+    设置 target_bytes 时，每个文件单独压缩到不超过该大小
+    设置 total_bytes 时，按 weighting 权重把总预算分配给各文件，
+    每个文件提交时才根据剩余预算分配，已完成文件节省下来的预算会分给后续文件；
+    输出大小与质量无关的文件（PNG 输出）按普通压缩处理，先从总预算中扣除其预估大小
+    目标大小模式下结果的 'over_target' 表示该文件没能压缩到分配的大小以内
+    结果的 'format' 为实际写出的格式，指定 output_format 时输出文件的扩展名随之改变
+    任务按图片头估算的峰值内存在 memory_budget（字节）内调度：小图片打包并发，
+    超出预算的大图片单独运行
+    manifest 为真时在输出目录写入清单，incremental 为真时跳过清单中未变化且参数相同的文件
+    dedup 为 'hardlink' 或 'copy' 时，内容相同的文件（先比较大小，再比较摘要）只压缩一次，
+    其余副本的输出硬链接或复制自第一份，结果中 'duplicate_of' 为第一份的输入路径；为 None 时不去重
+    progress_callback(已完成数, 总数, 单个结果) 在每个文件完成后调用，文件尚未全部发现时总数为 None
+    profile 为真或注册了性能记录回调时，每个结果的 'profile' 中带有各阶段的记录，
+    记录会在主进程中转发给回调，可用 ProfileSummary.from_results 汇总
+    cancel_token 被取消后不再提交新文件，撤回尚未开始的任务，等正在运行的文件完成后返回
+    quantizer 和 palette_proxy_pixels 选择减色的量化算法和生成调色板的缩小副本大小；
+    shared_palette 为真且需要减色时，先从抽样的文件生成一个共享调色板，所有文件直接映射到该调色板
+    返回每个文件的结果字典列表（取消时只包含已完成的文件）
+    """
+    if shared_palette and palette is None and (reduce_colors or extreme):
+        palette = folder_palette(input_folder, CompressionPlan(extreme=extreme).colors,
+                                 quantizer, exclude=output_folder)
+    params = folder_params(
+        quality, resize_scale, grayscale, reduce_colors, extreme, resize_method,
+        output_format, format_time_budget, png_effort, png_time_budget,
+        quantizer, palette_proxy_pixels, palette)
+    settings = batch_settings(params, target_bytes, total_bytes, weighting)
+    budget_mode = bool(total_bytes)
+    profile = profile or bool(_profile_hooks)
+
+    results = []
+    discovery = FileDiscovery(input_folder, exclude=output_folder)
+    batch_manifest = BatchManifest(input_folder, output_folder) if manifest else None
+
+    def output_for(input_path):
+        return batch_output_path(input_path, input_folder, output_folder)
+
+    def report(result):
+        results.append(result)
+        if progress_callback:
+            total = len(results) + len(in_flight) + len(ready) + (len(jobs) if budget_mode else 0)
+            total += sum(len(duplicates) for duplicates in waiting.values())
+            progress_callback(len(results), total if discovery.finished else None, result)
+
+    # 去重状态：按大小分组的首个文件、按需计算的摘要、首个文件的结果和等待首个文件完成的副本
+    size_groups = {}
+    digests = {}
+    original_results = {}
+    waiting = {}
+
+    def find_original(input_path):
+        """返回内容相同的已登记文件；没有时把该文件登记为首个文件并返回 None"""
+        if not dedup:
+            return None
+        try:
+            group = size_groups.setdefault(os.path.getsize(input_path), [])
+            if group:
+                # 只有大小相同时才计算摘要
+                digest = digests[input_path] = file_digest(input_path)
+                for other in group:
+                    if other not in digests:
+                        digests[other] = file_digest(other)
+                    if digests[other] == digest:
+                        return other
+        except OSError:
+            return None  # 无法读取，交给工作进程报告错误
+        group.append(input_path)
+        return None
+
+    def finish_duplicate(original, input_path, output_path):
+        """按首个文件的结果生成副本的输出和结果"""
+        if output_format:
+            output_path = format_output_path(output_path, original.get('format'))
+        result = dict(original, input=input_path, output=output_path,
+                      skipped=False, duplicate_of=original['input'])
+        result.pop('profile', None)
+        if not result['error']:
+            try:
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                link_or_copy(original['output'], output_path, dedup)
+            except OSError as e:
+                result['error'] = str(e)
+        if batch_manifest and not result['error']:
+            batch_manifest.append(result, settings)
+        report(result)
+
+    def add_duplicate(original_path, input_path, output_path):
+        """首个文件已完成时立即生成副本，否则等它完成"""
+        if original_path in original_results:
+            finish_duplicate(original_results[original_path], input_path, output_path)
+        else:
+            waiting.setdefault(original_path, []).append((input_path, output_path))
+
+    def original_done(result):
+        if not dedup:
+            return
+        original_results[result['input']] = result
+        for input_path, output_path in waiting.pop(result['input'], ()):
+            finish_duplicate(result, input_path, output_path)
+
+    def copies(input_path):
+        """首个文件连同等待它的副本一共输出的份数"""
+        return 1 + len(waiting.get(input_path, ()))
+
+    def skip_unchanged(input_path, output_path):
+        """清单中有未变化的记录时直接报告并返回结果，否则返回 None"""
+        if not (batch_manifest and incremental):
+            return None
+        try:
+            record = batch_manifest.lookup(input_path, settings)
+        except OSError:
+            return None
+        if record is None:
+            return None
+        result = {
+            'input': input_path,
+            'output': os.path.join(output_folder, record['output']),
+            'original_size': record['size'],
+            'compressed_size': record['output_size'],
+            'error': None,
+            'skipped': True,
+            'hash': record['hash'],
+        }
+        if record.get('format'):
+            result['format'] = record['format']
+        report(result)
+        return result
+
+    max_workers = max_workers or os.cpu_count() or 1
+    # 限制同时提交的任务数，避免上万个文件一次性堆积在进程间队列中
+    max_in_flight = max_workers * 4
+    plan = CompressionPlan(**params)
+    memory_budget = memory_budget or default_memory_budget()
+    used_memory = 0
+    # 队首任务被小任务插队的次数，超过工作进程数后等待内存释放，避免大图片饿死
+    head_skips = 0
+    stopping = False
+    ready = deque()
+    in_flight = {}
+    jobs = deque()
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_batch_worker) as executor:
+            if budget_mode:
+                # 预算分配需要全部文件的权重，先收集完整的文件列表
+                for input_path in discovery:
+                    if cancel_token is not None and cancel_token.cancelled:
+                        break
+                    output_path = output_for(input_path)
+                    skipped = skip_unchanged(input_path, output_path)
+                    original_path = find_original(input_path)
+                    if skipped is not None:
+                        # 已跳过文件的输出计入总预算
+                        total_bytes -= skipped['compressed_size']
+                        if original_path is None:
+                            original_done(skipped)
+                    elif original_path is not None:
+                        if original_path in original_results:
+                            total_bytes -= original_results[original_path]['compressed_size']
+                        add_duplicate(original_path, input_path, output_path)
+                    else:
+                        jobs.append((input_path, output_path))
+                weights = list(executor.map(
+                    _budget_weight_job,
+                    [(input_path, params, weighting) for input_path, _ in jobs],
+                    chunksize=16))
+                # 固定大小的文件不参与分配，预估大小在提交前一直从可分配的预算中扣除
+                fixed_sizes = {input_path: fixed * copies(input_path)
+                               for (input_path, _), (_, fixed) in zip(jobs, weights)
+                               if fixed is not None}
+                pending_fixed = sum(fixed_sizes.values())
+                # 文件无法读取时仍给一个最小权重，由压缩结果报告错误；
+                # 有副本的文件按输出份数加权，每份都计入总预算
+                jobs = deque((input_path, output_path,
+                              0 if input_path in fixed_sizes else max(weight, 1) * copies(input_path))
+                             for (input_path, output_path), (weight, _) in zip(jobs, weights))
+                remaining_weight = sum(weight for _, _, weight in jobs)
+                spent = 0
+                reserved = {}
+                # 预算模式下减少预先提交的任务，让节省的预算尽快分给后续文件
+                max_in_flight = max_workers
+
+            while True:
+                if not stopping and cancel_token is not None and cancel_token.cancelled:
+                    # 正在运行的文件仍会完成并写入清单，下次运行可以从这里继续
+                    stopping = True
+                    ready.clear()
+                    jobs.clear()
+                    for future in list(in_flight):
+                        if future.cancel():
+                            used_memory -= in_flight.pop(future)[1]
+                            if budget_mode:
+                                del reserved[future]
+                # 取下一批文件并读取图片头，估计峰值内存；没有任务在运行时阻塞等待发现
+                while not stopping and len(ready) < max_in_flight:
+                    if budget_mode:
+                        if not jobs:
+                            break
+                        input_path, output_path, weight = jobs.popleft()
+                    else:
+                        input_path = discovery.get(block=not in_flight and not ready)
+                        if input_path is None:
+                            break
+                        output_path = output_for(input_path)
+                        weight = 0
+                        skipped = skip_unchanged(input_path, output_path)
+                        original_path = find_original(input_path)
+                        if skipped is not None:
+                            if original_path is None:
+                                original_done(skipped)
+                            continue
+                        if original_path is not None:
+                            add_duplicate(original_path, input_path, output_path)
+                            continue
+                    try:
+                        cost = estimate_peak_memory(input_path, plan)
+                    except Exception:
+                        cost = 0  # 无法读取图片头，交给工作进程报告错误
+                    ready.append((input_path, output_path, weight, cost))
+
+                while ready and len(in_flight) < max_in_flight:
+                    position = None
+                    for i, (_, _, _, cost) in enumerate(ready):
+                        if not in_flight or used_memory + cost <= memory_budget:
+                            position = i
+                            break
+                        if head_skips >= max_workers:
+                            break
+                    if position is None:
+                        break
+                    head_skips = head_skips + 1 if position else 0
+                    input_path, output_path, weight, cost = ready[position]
+                    del ready[position]
+
+                    file_target = target_bytes
+                    if budget_mode and input_path in fixed_sizes:
+                        reservation = fixed_sizes.pop(input_path)
+                        pending_fixed -= reservation
+                    elif budget_mode:
+                        available = total_bytes - spent - sum(reserved.values()) - pending_fixed
+                        share = int(available * weight / remaining_weight)
+                        remaining_weight -= weight
+                        file_target = max(share // copies(input_path), 1)
+                        if target_bytes:
+                            file_target = min(file_target, target_bytes)
+                        reservation = file_target * copies(input_path)
+                    job = (input_path, output_path, params, file_target, profile, batch_manifest is not None)
+                    future = executor.submit(_compress_folder_job, job)
+                    in_flight[future] = (file_target, cost)
+                    if budget_mode:
+                        reserved[future] = reservation
+                    used_memory += cost
+                if not in_flight:
+                    if not stopping and (ready or not discovery.finished):
+                        continue
+                    break
+                # 文件仍在发现中或可能被取消时定期返回，及时补充新任务或响应取消
+                idle = stopping or (discovery.finished and cancel_token is None)
+                done, _ = wait(in_flight, timeout=None if idle else 0.05,
+                               return_when=FIRST_COMPLETED)
+                for future in done:
+                    file_target, cost = in_flight.pop(future)
+                    used_memory -= cost
+                    result = future.result()
+                    if profile:
+                        dispatch_profile_records(result['profile'])
+                    if budget_mode:
+                        result['target_bytes'] = file_target
+                        spent += result['compressed_size'] * copies(result['input'])
+                        del reserved[future]
+                    if batch_manifest and not result['error']:
+                        batch_manifest.append(result, settings)
+                    report(result)
+                    original_done(result)
+    finally:
+        discovery.close()
+        if batch_manifest:
+            batch_manifest.close()
+    return results
+
+def _prefetch_file(path):
+    """
+    映射文件并逐页访问一次，把内容读入页面缓存后返回映射
+    工作进程映射同一个文件时直接使用缓存的页面，文件内容不经过进程间传递
+    """
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return b''
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if hasattr(mapping, 'madvise'):
+        mapping.madvise(mmap.MADV_WILLNEED)
+    # 网络存储上预读提示不一定生效，逐页访问保证内容已经读入
+    for offset in range(0, size, mmap.PAGESIZE):
+        mapping[offset]
+    return mapping
+
+def _write_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if os.path.exists(path) and os.stat(path).st_nlink > 1:
+        # 与 compress_folder 一致，不改写与其他文件共享的硬链接
+        os.remove(path)
+    with open(path, 'wb') as f:
+        f.write(data)
+
+def _encode_buffer_job(job):
+    """
+    流水线批量压缩的工作进程入口：映射已预读到页面缓存的文件，解码并编码，不写入文件；
+    映射不缓存，任务结束时关闭
+    返回结果字典，'data' 为输出字节，无法变小时为 None（输出原文件内容），'format' 为输出格式
+    """
+    input_path, params, profile = job
+    profiler = StageProfiler(input_path, dispatch=False) if profile else NULL_PROFILER
+    result = {'data': None, 'format': None, 'reason': None, 'error': None}
+    try:
+        with open_source(input_path) as (img, source):
+            plan = CompressionPlan(**params)
+            result['data'], result['format'], result['reason'] = plan.compress(
+                img, input_path, len(source), profiler, source)
+    except Exception as e:
+        result['error'] = str(e)
+        profiler.record('error', error=str(e))
+    if profile:
+        result['profile'] = profiler.records
+    return result
+
+async def _compress_folder_pipeline(input_folder, output_folder, params, prefetch, max_workers,
+                                    progress_callback, profile, cancel_token):
+    loop = asyncio.get_running_loop()
+    results = []
+    discovery = FileDiscovery(input_folder, exclude=output_folder)
+    # 同时处理的文件数：工作进程各一个，另外预读 prefetch 个
+    slots = asyncio.Semaphore(max_workers + prefetch)
+    io_pool = ThreadPoolExecutor(max_workers=prefetch + 1)
+
+    async def process(input_path):
+        output_path = batch_output_path(input_path, input_folder, output_folder)
+        result = {
+            'input': input_path,
+            'output': output_path,
+            'original_size': 0,
+            'compressed_size': 0,
+            'error': None,
+            'skipped': False,
+        }
+        records = []
+        try:
+            start = time.perf_counter()
+            source_data = await loop.run_in_executor(io_pool, _prefetch_file, input_path)
+            records.append({'file': input_path, 'stage': 'read', 'seconds': time.perf_counter() - start,
+                            'bytes_in': len(source_data)})
+            result['original_size'] = len(source_data)
+            encoded = await loop.run_in_executor(
+                cpu_pool, _encode_buffer_job, (input_path, params, profile))
+            records.extend(encoded.get('profile', ()))
+            if encoded['error']:
+                result['error'] = encoded['error']
+                return
+            # 无法变小时写出已读入的原文件内容
+            output_data = source_data if encoded['data'] is None else encoded['data']
+            result['format'] = encoded['format']
+            if params.get('output_format'):
+                output_path = result['output'] = format_output_path(output_path, encoded['format'])
+            start = time.perf_counter()
+            await loop.run_in_executor(io_pool, _write_file, output_path, output_data)
+            records.append({'file': input_path, 'stage': 'write', 'seconds': time.perf_counter() - start,
+                            'bytes_out': len(output_data)})
+            result['compressed_size'] = len(output_data)
+            result['passthrough'] = encoded['data'] is None
+        except Exception as e:
+            result['error'] = str(e)
+        finally:
+            slots.release()
+            if profile:
+                result['profile'] = records
+                dispatch_profile_records(records)
+            results.append(result)
+            if progress_callback:
+                progress_callback(len(results), discovery.count if discovery.finished else None, result)
+
+    tasks = []
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_batch_worker) as cpu_pool:
+            while True:
+                await slots.acquire()
+                input_path = None
+                if not (cancel_token is not None and cancel_token.cancelled):
+                    # 文件发现可能阻塞在网络存储上，放到线程中等待
+                    input_path = await loop.run_in_executor(io_pool, discovery.get)
+                if input_path is None:
+                    slots.release()
+                    break
+                tasks.append(asyncio.create_task(process(input_path)))
+            await asyncio.gather(*tasks)
+    finally:
+        discovery.close()
+        io_pool.shutdown(wait=False)
+    return results
+
+def compress_folder_pipelined(input_folder, output_folder, quality=80, prefetch=8, max_workers=None,
+                              progress_callback=None, profile=False, cancel_token=None, **options):
+    """
+    流水线方式批量压缩文件夹，适合网络存储等 I/O 较慢的场景
+    asyncio 事件循环把后续 prefetch 个文件映射并预读到页面缓存，工作进程在每个任务中映射同一文件
+    直接解码和编码（不复制文件内容，任务结束即关闭映射），
+    输出由 I/O 线程异步写出，不同文件的读取、编码和写入同时进行；
+    大小直接取自映射的长度，不再查询文件信息
+    options 为 compress_image 的其余压缩参数；不支持目标大小、清单和去重，需要时使用 compress_folder
+    progress_callback、profile 和 cancel_token 与 compress_folder 相同，返回每个文件的结果字典列表
+    """
+    params = dict(options, quality=quality)
+    max_workers = max_workers or os.cpu_count() or 1
+    profile = profile or bool(_profile_hooks)
+    return asyncio.run(_compress_folder_pipeline(
+        input_folder, output_folder, params, max(prefetch, 1), max_workers,
+        progress_callback, profile, cancel_token))
 
 def format_size(size):
     """
@@ -189,20 +2736,29 @@ def format_size(size):
     else:
         return f"{size / (1024 ** 2):.2f} MB"
 
-def debounce(wait):
+def debounce(wait, max_wait=None):
     """
     防抖装饰器，用于延迟函数执行
+    max_wait 不为空时，连续不断的调用最多把执行推迟 max_wait 秒
     """
     def decorator(func):
         @functools.wraps(func)
         def debounced(*args, **kwargs):
             def call_it():
+                debounced.first_call = None
                 func(*args, **kwargs)
             try:
                 debounced.timer.cancel()
             except (AttributeError, NameError):
                 pass
-            debounced.timer = threading.Timer(wait, call_it)
+            delay = wait
+            if max_wait is not None:
+                now = time.monotonic()
+                if debounced.first_call is None:
+                    debounced.first_call = now
+                delay = max(min(wait, debounced.first_call + max_wait - now), 0)
+            debounced.timer = threading.Timer(delay, call_it)
             debounced.timer.start()
+        debounced.first_call = None
         return debounced
     return decorator    
\ No newline at end of file
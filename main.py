@@ -1,10 +1,16 @@
-import tkinter as tk
-from ui import ImageCompressorUI
+import sys
 
 def main():
+    # 带命令行参数时进入命令行模式，不加载 tkinter
+    if len(sys.argv) > 1:
+        from cli import main as cli_main
+        return cli_main()
+
+    import tkinter as tk
+    from ui import ImageCompressorUI
     root = tk.Tk()
     app = ImageCompressorUI(root)
     root.mainloop()
 
 if __name__ == "__main__":
-    main()    
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
@@ -0,0 +1,83 @@
+import os
+
+from core import SizeCache
+
+
+def make_file(path, content=b'data'):
+    path.write_bytes(content)
+    return str(path)
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = SizeCache(maxsize=2)
+    path = make_file(tmp_path / 'a.jpg')
+    cache.put(path, 'output', {'quality': 10}, 100)
+    cache.put(path, 'output', {'quality': 20}, 200)
+    # 读取后 quality=10 变为最近使用，下一次淘汰 quality=20
+    assert cache.get(path, 'output', {'quality': 10}) == 100
+    cache.put(path, 'output', {'quality': 30}, 300)
+    assert cache.get(path, 'output', {'quality': 20}) is None
+    assert cache.get(path, 'output', {'quality': 10}) == 100
+    assert cache.get(path, 'output', {'quality': 30}) == 300
+
+
+def test_key_includes_kind_and_params(tmp_path):
+    cache = SizeCache()
+    path = make_file(tmp_path / 'a.jpg')
+    cache.put(path, 'output', {'quality': 80, 'grayscale': False}, 100)
+    assert cache.get(path, 'estimate', {'quality': 80, 'grayscale': False}) is None
+    assert cache.get(path, 'output', {'quality': 80, 'grayscale': True}) is None
+    # 参数顺序不影响键
+    assert cache.get(path, 'output', {'grayscale': False, 'quality': 80}) == 100
+
+
+def test_modified_file_invalidates_entries(tmp_path):
+    cache = SizeCache()
+    path = make_file(tmp_path / 'a.jpg')
+    cache.put(path, 'output', {'quality': 80}, 100)
+    stat = os.stat(path)
+    os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    assert cache.get(path, 'output', {'quality': 80}) is None
+
+
+def test_missing_file_is_not_cached(tmp_path):
+    cache = SizeCache()
+    path = str(tmp_path / 'missing.jpg')
+    cache.put(path, 'output', {'quality': 80}, 100)
+    assert cache.get(path, 'output', {'quality': 80}) is None
+
+
+def test_save_and_load_round_trip(tmp_path):
+    path = make_file(tmp_path / 'a.jpg')
+    cache_path = str(tmp_path / 'cache.json')
+    cache = SizeCache()
+    cache.put(path, 'output', {'quality': 80, 'resize_method': 'balanced'}, 100)
+    cache.put(path, 'target', {'target_bytes': 5000}, 42)
+    cache.save(cache_path)
+    assert not os.path.exists(cache_path + '.tmp')
+
+    loaded = SizeCache()
+    loaded.load(cache_path)
+    assert loaded.get(path, 'output', {'quality': 80, 'resize_method': 'balanced'}) == 100
+    assert loaded.get(path, 'target', {'target_bytes': 5000}) == 42
+
+
+def test_load_respects_maxsize_and_ignores_corrupt_file(tmp_path):
+    path = make_file(tmp_path / 'a.jpg')
+    cache_path = str(tmp_path / 'cache.json')
+    cache = SizeCache()
+    for quality in range(5):
+        cache.put(path, 'output', {'quality': quality}, quality)
+    cache.save(cache_path)
+
+    small = SizeCache(maxsize=2)
+    small.load(cache_path)
+    # 只保留最近写入的条目
+    assert small.get(path, 'output', {'quality': 0}) is None
+    assert small.get(path, 'output', {'quality': 4}) == 4
+
+    (tmp_path / 'broken.json').write_text('{not json', encoding='utf-8')
+    empty = SizeCache()
+    empty.load(str(tmp_path / 'broken.json'))
+    empty.load(str(tmp_path / 'nonexistent.json'))
+    assert empty.get(path, 'output', {'quality': 4}) is None
@@ -0,0 +1,42 @@
+import pytest
+from PIL import Image
+
+from core import compress_image, compress_to_target_size, format_output_path
+
+
+@pytest.mark.parametrize('output_path, output_format, expected', [
+    ('out/compressed_a.jpg', 'WEBP', 'out/compressed_a.webp'),
+    ('out/compressed_a.png', 'JPEG', 'out/compressed_a.jpg'),
+    ('out/compressed_a.JPEG', 'JPEG', 'out/compressed_a.JPEG'),
+    ('out/compressed_a.jpeg', 'PNG', 'out/compressed_a.png'),
+    ('out/compressed_a.gif', 'GIF', 'out/compressed_a.gif'),
+    ('out/compressed_a.gif', None, 'out/compressed_a.gif'),
+    (None, 'PNG', None),
+])
+def test_format_output_path(output_path, output_format, expected):
+    assert format_output_path(output_path, output_format) == expected
+
+
+def test_target_size_reports_unreadable_file_under_target(tmp_path):
+    # 比目标小的文件也要先识别格式，无法识别时返回错误而不是抛出异常
+    broken = tmp_path / 'broken.jpg'
+    broken.write_bytes(b'junk\n')
+    size, error = compress_to_target_size(str(broken), str(tmp_path / 'out.jpg'), 200 * 1024)
+    assert size == 0
+    assert 'cannot identify image file' in error
+    assert not (tmp_path / 'out.jpg').exists()
+
+
+@pytest.mark.parametrize('output_format, extension', [('PNG', '.png'), ('WEBP', '.webp')])
+def test_cmyk_source_converted_for_explicit_format(tmp_path, output_format, extension):
+    # JPEG 能保存 CMYK，PNG 和 WebP 需要先转换
+    source = tmp_path / 'cmyk.jpg'
+    Image.new('RGB', (64, 48), (30, 120, 200)).convert('CMYK').save(source)
+    details = {}
+    size = compress_image(str(source), str(tmp_path / 'out.jpg'), output_format=output_format,
+                          details=details)
+    assert isinstance(size, int) and size > 0
+    assert details['output'] == str(tmp_path / ('out' + extension))
+    with Image.open(details['output']) as img:
+        assert img.format == output_format
+        assert img.mode == 'RGB'
@@ -0,0 +1,119 @@
+import os
+
+from PIL import Image
+
+from core import MANIFEST_NAME, BatchManifest, compress_folder, file_digest
+
+SETTINGS = {'quality': 80, 'resize_scale': 100}
+
+
+def setup_folders(tmp_path, content=b'original image'):
+    input_folder = tmp_path / 'in'
+    output_folder = tmp_path / 'out'
+    input_folder.mkdir()
+    output_folder.mkdir()
+    source = input_folder / 'a.jpg'
+    source.write_bytes(content)
+    output = output_folder / 'compressed_a.jpg'
+    output.write_bytes(b'small')
+    return str(input_folder), str(output_folder), str(source), str(output)
+
+
+def record_result(manifest, source, output):
+    manifest.append({'input': source, 'output': output, 'hash': file_digest(source),
+                     'compressed_size': os.path.getsize(output), 'format': 'JPEG'}, SETTINGS)
+
+
+def test_lookup_returns_record_for_unchanged_file(tmp_path):
+    input_folder, output_folder, source, output = setup_folders(tmp_path)
+    manifest = BatchManifest(input_folder, output_folder)
+    assert manifest.lookup(source, SETTINGS) is None
+    record_result(manifest, source, output)
+    record = manifest.lookup(source, SETTINGS)
+    assert record['output'] == 'compressed_a.jpg'
+    assert record['format'] == 'JPEG'
+    manifest.close()
+
+
+def test_records_persist_across_runs(tmp_path):
+    input_folder, output_folder, source, output = setup_folders(tmp_path)
+    manifest = BatchManifest(input_folder, output_folder)
+    record_result(manifest, source, output)
+    record_result(manifest, source, output)
+    manifest.close()
+
+    reopened = BatchManifest(input_folder, output_folder)
+    assert reopened.lookup(source, SETTINGS) is not None
+    reopened.close()
+    # 重新打开时压缩旧记录，每个输入只保留一条
+    with open(os.path.join(output_folder, MANIFEST_NAME), encoding='utf-8') as f:
+        assert len(f.readlines()) == 1
+
+
+def test_changed_settings_invalidate(tmp_path):
+    input_folder, output_folder, source, output = setup_folders(tmp_path)
+    manifest = BatchManifest(input_folder, output_folder)
+    record_result(manifest, source, output)
+    assert manifest.lookup(source, dict(SETTINGS, quality=60)) is None
+    manifest.close()
+
+
+def test_changed_or_missing_output_invalidates(tmp_path):
+    input_folder, output_folder, source, output = setup_folders(tmp_path)
+    manifest = BatchManifest(input_folder, output_folder)
+    record_result(manifest, source, output)
+    with open(output, 'ab') as f:
+        f.write(b'more')
+    assert manifest.lookup(source, SETTINGS) is None
+    os.remove(output)
+    assert manifest.lookup(source, SETTINGS) is None
+    manifest.close()
+
+
+def test_touched_file_with_same_content_is_skipped(tmp_path):
+    input_folder, output_folder, source, output = setup_folders(tmp_path)
+    manifest = BatchManifest(input_folder, output_folder)
+    record_result(manifest, source, output)
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    assert manifest.lookup(source, SETTINGS) is not None
+    manifest.close()
+
+
+def test_changed_content_invalidates(tmp_path):
+    input_folder, output_folder, source, output = setup_folders(tmp_path)
+    manifest = BatchManifest(input_folder, output_folder)
+    record_result(manifest, source, output)
+    stat = os.stat(source)
+    # 大小相同、内容不同时由摘要判断
+    with open(source, 'wb') as f:
+        f.write(b'changed image!')
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000000000))
+    assert manifest.lookup(source, SETTINGS) is None
+    with open(source, 'wb') as f:
+        f.write(b'longer changed image')
+    assert manifest.lookup(source, SETTINGS) is None
+    manifest.close()
+
+
+def test_compress_folder_skips_unchanged_files(tmp_path):
+    input_folder = tmp_path / 'in'
+    output_folder = tmp_path / 'out'
+    input_folder.mkdir()
+    for name in ('a.jpg', 'b.jpg'):
+        Image.effect_noise((96, 64), 64).convert('RGB').save(input_folder / name, quality=95)
+
+    first = compress_folder(str(input_folder), str(output_folder), max_workers=1)
+    assert [r['error'] for r in first] == [None, None]
+    assert not any(r['skipped'] for r in first)
+
+    second = compress_folder(str(input_folder), str(output_folder), max_workers=1)
+    assert all(r['skipped'] for r in second)
+
+    # 改变参数或文件内容后重新压缩
+    third = compress_folder(str(input_folder), str(output_folder), quality=50, max_workers=1)
+    assert not any(r['skipped'] for r in third)
+    Image.effect_noise((80, 80), 64).convert('RGB').save(input_folder / 'a.jpg', quality=95)
+    fourth = compress_folder(str(input_folder), str(output_folder), quality=50, max_workers=1)
+    skipped = {os.path.basename(r['input']): r['skipped'] for r in fourth}
+    assert skipped == {'a.jpg': False, 'b.jpg': True}
@@ -0,0 +1,97 @@
+import math
+
+import pytest
+
+from core import QualityCurveModel, search_quality
+
+# photo_mixed.jpg 在各质量下的实际大小，其余质量按 log(大小) 线性插值
+PHOTO_MIXED = {5: 50334, 9: 90636, 10: 103162, 12: 127648, 13: 140395, 16: 176975,
+               18: 201284, 24: 262878, 30: 312092, 50: 436549, 75: 663352, 100: 1500000}
+
+
+def curve_size(table, quality):
+    if quality in table:
+        return table[quality]
+    low = max(q for q in table if q < quality)
+    high = min(q for q in table if q > quality)
+    t = (quality - low) / (high - low)
+    return int(math.exp(math.log(table[low]) + t * (math.log(table[high]) - math.log(table[low]))))
+
+
+def make_probe(table, probes):
+    def probe(quality):
+        probes.append(quality)
+        return b'x' * curve_size(table, quality)
+    return probe
+
+
+def test_extrapolated_guess_does_not_stop_early():
+    # 试探 q5、q30、q18 后，由 q18 和 q30 外推的猜测紧挨着 q5，不能因此停在 q5
+    probes = []
+    quality, data = search_quality(make_probe(PHOTO_MIXED, probes), 131351, 1000 * 1000,
+                                   curves=QualityCurveModel(), initial_quality=5)
+    assert probes[:3] == [5, 30, 18]
+    assert quality == 12
+    assert len(data) == 127648
+
+
+def synthetic_size(quality):
+    # 每像素字节数随质量指数增长，接近真实 JPEG 的质量-大小曲线
+    return int(20000 * math.exp(0.035 * quality))
+
+
+def best_fitting(target, low=5):
+    return max((q for q in range(low, 101) if synthetic_size(q) <= target), default=None)
+
+
+@pytest.mark.parametrize('target', [30000, 60000, 120000, 250000, 500000])
+def test_search_converges_to_fitting_quality(target):
+    probes = []
+
+    def probe(quality):
+        probes.append(quality)
+        return b'x' * synthetic_size(quality)
+
+    quality, data = search_quality(probe, target, 640 * 480, curves=QualityCurveModel())
+    assert len(data) == synthetic_size(quality) <= target
+    # 停在容差窗口内，或离可行的最高质量不超过 bracket
+    assert len(data) >= target * 0.95 or quality >= best_fitting(target) - 2
+    assert len(probes) <= 10
+
+
+def test_search_returns_smallest_when_nothing_fits():
+    quality, data = search_quality(lambda q: b'x' * synthetic_size(q), 1000, 640 * 480,
+                                   curves=QualityCurveModel())
+    assert quality == 5
+    assert len(data) == synthetic_size(5)
+
+
+def test_shared_curve_reduces_probes():
+    curves = QualityCurveModel()
+    counts = []
+    for target in (120000, 125000):
+        probes = []
+
+        def probe(quality):
+            probes.append(quality)
+            return b'x' * synthetic_size(quality)
+
+        search_quality(probe, target, 640 * 480, curve_key='photo', curves=curves)
+        counts.append(len(probes))
+    # 第二次搜索从第一次学到的曲线出发
+    assert counts[1] <= 2
+    assert counts[1] < counts[0]
+
+
+def test_cached_sizes_skip_encoding():
+    probes = []
+
+    def probe(quality):
+        probes.append(quality)
+        return b'x' * synthetic_size(quality)
+
+    quality, data = search_quality(probe, 120000, 640 * 480, curves=QualityCurveModel(),
+                                   cached_size=synthetic_size)
+    # 只有最终选中的质量需要真正编码
+    assert probes == [quality]
+    assert len(data) == synthetic_size(quality)
@@ -6,13 +6,19 @@ import sys
 # 检查必要依赖
 try:
     from PIL import Image
-    from concurrent.futures import ThreadPoolExecutor
     from core import *
     HAS_DEPENDENCIES = True
 except ImportError as e:
     HAS_DEPENDENCIES = False
     MISSING_DEPENDENCY = str(e)
 
+# 缩放算法选项与 core.RESIZE_PRESETS 的对应关系
+RESIZE_METHOD_LABELS = {"高质量": 'quality', "均衡": 'balanced', "快速": 'fast'}
+
+# 单文件压缩各阶段完成时进度条的位置，目标大小搜索会多次经过 encode 阶段
+STAGE_PROGRESS = {'decode': 30, 'alpha': 35, 'quantize': 45, 'resize': 55, 'grayscale': 60,
+                  'encode': 90, 'write': 100}
+
 class MissingDependencyDialog:
     """显示缺失依赖的对话框"""
     def __init__(self, root):
@@ -74,13 +80,27 @@ class ImageCompressorUI:
         self.mode = tk.StringVar(value="file")
         self.quality = tk.IntVar(value=15)  # 降低默认质量到15
         self.output_queue = Queue()
-        self.executor = ThreadPoolExecutor(max_workers=min(4, os.cpu_count() or 1))
+        # 压缩任务句柄，压缩过程中可以取消；新的文件夹预估会取消仍在运行的旧预估
+        self.compress_job = None
+        self.estimate_slot = JobSlot()
         self.is_compressing = False
         self.extreme_compression = tk.BooleanVar(value=False)
         
+        # 加载上次会话保存的大小缓存，关闭窗口时保存
+        size_cache.load(DEFAULT_CACHE_PATH)
+        master.protocol("WM_DELETE_WINDOW", self.on_close)
+        
         # 创建界面组件
         self.create_widgets()
         
+    def on_close(self):
+        """关闭窗口前保存大小缓存"""
+        self.estimate_slot.cancel()
+        if self.compress_job is not None:
+            self.compress_job.cancel()
+        size_cache.save(DEFAULT_CACHE_PATH)
+        self.master.destroy()
+        
     def show_about(self):
         """显示关于对话框"""
         messagebox.showinfo(
@@ -163,6 +183,11 @@ class ImageCompressorUI:
         self.size_unit.current(0)
         self.size_unit.pack(side=tk.LEFT, padx=(0, 5))
         
+        # 文件夹模式下目标大小的含义：每个文件上限或整个文件夹总大小
+        self.size_scope = ttk.Combobox(size_input_frame, values=["每个文件", "总大小"], width=8, state="readonly")
+        self.size_scope.current(0)
+        self.size_scope.pack(side=tk.LEFT, padx=(0, 5))
+        
         ttk.Button(size_input_frame, text="应用", command=self.apply_target_size).pack(side=tk.LEFT)
         
         # 显示预估大小的标签
@@ -194,6 +219,14 @@ class ImageCompressorUI:
         self.resize_label = ttk.Label(resize_frame, text="80%")
         self.resize_label.pack(side=tk.LEFT)
         
+        # 缩放算法：均衡和快速会对 JPEG 使用草稿解码
+        ttk.Label(resize_frame, text="缩放算法:").pack(side=tk.LEFT, padx=(10, 0))
+        self.resize_method = ttk.Combobox(resize_frame, values=list(RESIZE_METHOD_LABELS), width=6, state="readonly")
+        self.resize_method.current(1)
+        self.resize_method.pack(side=tk.LEFT)
+        # 更换缩放算法后预估大小会变化，与质量滑块一样重新预估
+        self.resize_method.bind("<<ComboboxSelected>>", self.debounced_update_estimated_size)
+        
         # 颜色选项
         color_frame = ttk.Frame(advanced_frame)
         color_frame.pack(fill=tk.X, expand=True, padx=5, pady=5)
@@ -220,6 +253,10 @@ class ImageCompressorUI:
         # 绑定缩放比例更新事件
         self.resize_scale.config(command=self.update_resize_label)
         
+    def get_resize_method(self):
+        """当前选择的缩放算法预设"""
+        return RESIZE_METHOD_LABELS[self.resize_method.get()]
+        
     def update_resize_label(self, value):
         """更新缩放比例标签"""
         self.resize_label.config(text=f"{int(float(value))}%")
@@ -309,6 +346,7 @@ class ImageCompressorUI:
         grayscale = self.grayscale.get()
         reduce_colors = self.reduce_colors.get()
         extreme = self.extreme_compression.get()
+        resize_method = self.get_resize_method()
             
         if self.mode.get() == "file":
             size = estimate_file_size(
@@ -316,7 +354,8 @@ class ImageCompressorUI:
                 resize_scale=resize_scale,
                 grayscale=grayscale,
                 reduce_colors=reduce_colors,
-                extreme=extreme
+                extreme=extreme,
+                resize_method=resize_method
             )
             if size > 0:
                 self.size_label.config(text=f"预估压缩后文件大小: {format_size(size)}")
@@ -325,98 +364,37 @@ class ImageCompressorUI:
         else:
             self.size_label.config(text="正在预估文件夹内文件大小...")
             
-            threading.Thread(
-                target=estimate_folder_size,
-                args=(
-                    self.selected_path, 
-                    quality, 
-                    self.output_queue,
-                    resize_scale,
-                    grayscale,
-                    reduce_colors,
-                    extreme
-                ),
-                daemon=True
-            ).start()
-            self.master.after(100, self.check_estimate_result)
-            
-    def check_estimate_result(self):
+            # 每次预估使用新的队列，被取代的旧预估即使还有结果也不会显示
+            self.output_queue = output_queue = Queue()
+            folder_path = self.selected_path
+            self.estimate_slot.submit(
+                lambda token, emit: estimate_folder_size_sampled(
+                    folder_path, quality, output_queue,
+                    resize_scale, grayscale, reduce_colors, extreme, resize_method,
+                    cancel_token=token))
+            self.master.after(100, self.check_estimate_result, output_queue)
+    
+    def check_estimate_result(self, output_queue):
         """
-        检查异步预估结果
+        检查异步预估结果，抽样预估会不断放入更精确的结果
         """
-        if not self.output_queue.empty():
-            total_size = self.output_queue.get()
+        if output_queue is not self.output_queue:
+            return  # 已被新的预估取代
+        finished = False
+        while not output_queue.empty():
+            total_size, low, high, finished = output_queue.get()
             if total_size > 0:
-                self.size_label.config(text=f"预估所有压缩后文件总大小: {format_size(total_size)}")
-            else:
+                text = f"预估所有压缩后文件总大小: {format_size(total_size)}"
+                if high > low:
+                    text += f" ({format_size(low)} - {format_size(high)})"
+                if not finished:
+                    text += " 正在细化..."
+                self.size_label.config(text=text)
+            elif finished:
                 self.size_label.config(text="无法预估文件夹大小，请检查文件格式")
-        else:
-            self.master.after(100, self.check_estimate_result)
-            
-    def compress_to_target_size(self, input_path, output_path, target_bytes, max_iterations=10, tolerance=0.05,
-                              resize_scale=100, grayscale=False, reduce_colors=False, extreme=False):
-        """
-        精确压缩到目标文件大小，使用二分查找算法，增强压缩效果
-        """
-        original_size = os.path.getsize(input_path)
-        if original_size <= target_bytes:
-            return original_size, 100
+        if not finished:
+            self.master.after(100, self.check_estimate_result, output_queue)
             
-        low = 5
-        high = 100
-        best_quality = 80
-        best_size = original_size
-        
-        for i in range(max_iterations):
-            quality = (low + high) // 2
-            # 增加收敛条件，如果high和low非常接近，提前结束
-            if high - low <= 5:
-                break
-                
-            # 创建临时文件估算大小
-            temp_file = generate_temp_file_path(input_path)
-            try:
-                result = compress_image(input_path, temp_file, quality, 
-                                     resize_scale=resize_scale, 
-                                     grayscale=grayscale, 
-                                     reduce_colors=reduce_colors,
-                                     extreme=extreme)
-                if isinstance(result, tuple):
-                    temp_size = result[0]
-                    if temp_size == 0:
-                        # 压缩失败，尝试其他参数
-                        high = quality - 1
-                        continue
-                else:
-                    temp_size = result
-            finally:
-                if os.path.exists(temp_file):
-                    os.remove(temp_file)
-            
-            if abs(temp_size - target_bytes) / target_bytes <= tolerance:
-                best_quality = quality
-                best_size = temp_size
-                break
-                
-            if temp_size > target_bytes:
-                high = quality - 1
-            else:
-                low = quality + 1
-                
-            if abs(temp_size - target_bytes) < abs(best_size - target_bytes):
-                best_quality = quality
-                best_size = temp_size
-                
-        # 执行实际压缩
-        actual_size = compress_image(input_path, output_path, best_quality,
-                                  resize_scale=resize_scale,
-                                  grayscale=grayscale,
-                                  reduce_colors=reduce_colors,
-                                  extreme=extreme)
-        if isinstance(actual_size, tuple):
-            actual_size = actual_size[0]
-        return actual_size, best_quality
-        
     def apply_target_size(self):
         """
         应用用户指定的目标文件大小
@@ -460,44 +438,54 @@ class ImageCompressorUI:
                 grayscale = self.grayscale.get()
                 reduce_colors = self.reduce_colors.get()
                 extreme = self.extreme_compression.get()
+                resize_method = self.get_resize_method()
                 
-                # 使用临时文件测试压缩
-                temp_file = generate_temp_file_path(self.selected_path)
-                result = self.compress_to_target_size(
-                    self.selected_path, temp_file, target_bytes,
+                # 只在内存中搜索质量，不写出临时文件
+                result = compress_to_target_size(
+                    self.selected_path, None, target_bytes,
                     resize_scale=resize_scale, grayscale=grayscale, 
-                    reduce_colors=reduce_colors, extreme=extreme)
-                os.remove(temp_file)
+                    reduce_colors=reduce_colors, extreme=extreme,
+                    resize_method=resize_method)
                 
-                if isinstance(result, tuple):
+                if isinstance(result, tuple) and result[0] > 0:
                     actual_size, quality = result
                     # 更新质量设置
                     self.quality.set(quality)
                     self.quality_label.config(text=f"精确质量: {quality}")
-                    self.size_label.config(text=f"预估压缩后大小: {format_size(actual_size)}")
+                    if actual_size > target_bytes:
+                        self.size_label.config(
+                            text=f"预估压缩后大小: {format_size(actual_size)}（无法达到目标大小）")
+                    else:
+                        self.size_label.config(text=f"预估压缩后大小: {format_size(actual_size)}")
                 else:
                     messagebox.showerror("错误", "无法达到目标大小")
             else:
-                messagebox.showinfo("提示", "文件夹模式暂不支持目标大小设置")
+                scope = self.size_scope.get()
+                messagebox.showinfo(
+                    "提示",
+                    f"开始压缩时将按{scope}不超过 {format_size(int(target_bytes))} 压缩文件夹内图片")
                 
         except Exception as e:
             messagebox.showerror("错误", f"设置目标大小时出错: {str(e)}")
             
     def start_compression(self):
         """
-        开始压缩任务
+        开始压缩任务，压缩过程中再次点击按钮会取消任务
         """
         if self.is_compressing:
-            messagebox.showinfo("提示", "正在压缩中，请等待当前任务完成")
+            # 正在处理的阶段或文件完成后停止
+            if self.compress_job is not None:
+                self.compress_job.cancel()
+                self.compress_button.config(text="正在取消...", state=tk.DISABLED)
             return
-            
+
         quality = self.quality.get()
         if not self.selected_path:
             messagebox.showerror("错误", "请选择输入文件或文件夹")
             return
             
         self.is_compressing = True
-        self.compress_button.config(state=tk.DISABLED)
+        self.compress_button.config(text="取消压缩")
         self.progress["value"] = 0
         
         # 确认对话框，特别是在极限压缩模式下
@@ -506,16 +494,39 @@ class ImageCompressorUI:
             confirm = messagebox.askyesno("确认", "极限压缩模式可能会显著影响图片质量，是否继续？")
             if not confirm:
                 self.is_compressing = False
-                self.compress_button.config(state=tk.NORMAL)
+                self.compress_button.config(text="开始压缩")
                 return
-                
-        if self.mode.get() == "file":
-            self.executor.submit(self.compress_single_file, quality)
-        else:
-            self.executor.submit(self.compress_folder, quality)
-            
-    def compress_single_file(self, quality):
-        """压缩单个文件的处理函数"""
+        
+        work = self.compress_single_file if self.mode.get() == "file" else self.compress_folder
+        self.compress_job = start_job(
+            lambda token, emit: work(quality, token, emit),
+            on_event=lambda event: self.master.after(0, self.handle_job_event, event))
+    
+    def handle_job_event(self, event):
+        """
+        在主线程中处理压缩任务的进度事件
+        """
+        if event['type'] == 'stage':
+            position = STAGE_PROGRESS.get(event['stage'], 0)
+            self.progress["value"] = max(self.progress["value"], position)
+        elif event['type'] == 'file':
+            # 文件仍在发现中时总数未知，只显示已完成数量
+            done, total = event['done'], event['total']
+            if total:
+                self.progress_label.config(text=f"进度: {done}/{total}")
+                self.progress.config(value=done * 100 / total)
+            else:
+                self.progress_label.config(text=f"进度: {done}")
+        elif event['type'] == 'done':
+            self.is_compressing = False
+            self.compress_button.config(text="开始压缩", state=tk.NORMAL)
+            if event['cancelled']:
+                messagebox.showinfo("提示", "压缩已取消")
+    
+    def compress_single_file(self, quality, cancel_token, emit):
+        """压缩单个文件的处理函数，在任务线程中运行"""
+        # 每个阶段开始前检查取消，结束后发出进度事件
+        profiler = JobProfiler(self.selected_path, cancel_token, emit)
         try:
             # 使用自定义输出路径或默认路径
             if self.output_path and os.path.isdir(self.output_path):
@@ -534,8 +545,10 @@ class ImageCompressorUI:
             grayscale = self.grayscale.get()
             reduce_colors = self.reduce_colors.get()
             extreme = self.extreme_compression.get()
+            resize_method = self.get_resize_method()
             
             # 检查是否设置了目标大小
+            target_bytes = None
             target_size_str = self.size_entry.get().strip()
             if target_size_str:
                 try:
@@ -544,10 +557,11 @@ class ImageCompressorUI:
                     target_bytes = target_size * 1024 if unit == "KB" else target_size * 1024 * 1024
                     
                     # 压缩到目标大小
-                    result = self.compress_to_target_size(
+                    result = compress_to_target_size(
                         self.selected_path, output_file, target_bytes,
                         resize_scale=resize_scale, grayscale=grayscale, 
-                        reduce_colors=reduce_colors, extreme=extreme)
+                        reduce_colors=reduce_colors, extreme=extreme,
+                        resize_method=resize_method, profiler=profiler)
                     
                     # 统一处理返回结果
                     if isinstance(result, tuple):
@@ -563,7 +577,8 @@ class ImageCompressorUI:
                     result = compress_image(
                         self.selected_path, output_file, quality,
                         resize_scale=resize_scale, grayscale=grayscale, 
-                        reduce_colors=reduce_colors, extreme=extreme)
+                        reduce_colors=reduce_colors, extreme=extreme,
+                        resize_method=resize_method, profiler=profiler)
                     
                     # 处理压缩结果
                     if isinstance(result, tuple):
@@ -578,7 +593,8 @@ class ImageCompressorUI:
                 result = compress_image(
                     self.selected_path, output_file, quality,
                     resize_scale=resize_scale, grayscale=grayscale, 
-                    reduce_colors=reduce_colors, extreme=extreme)
+                    reduce_colors=reduce_colors, extreme=extreme,
+                    resize_method=resize_method, profiler=profiler)
                 
                 # 处理压缩结果
                 if isinstance(result, tuple):
@@ -592,20 +608,101 @@ class ImageCompressorUI:
             # 压缩成功处理
             original_size = os.path.getsize(self.selected_path)
             reduction = 100 - int((compressed_size / original_size) * 100)
+            # PNG 输出或最低质量仍然超出时，目标大小无法达到
+            note = ""
+            if target_bytes and compressed_size > target_bytes:
+                note = f"\n\n注意：无法压缩到目标大小 {format_size(int(target_bytes))} 以内"
             self.master.after(0, lambda: messagebox.showinfo(
                 "成功", 
                 f"压缩完成!\n\n"
                 f"原始大小: {original_size//1024} KB\n"
                 f"压缩后大小: {compressed_size//1024} KB\n"
-                f"缩减比例: {reduction}%"
+                f"缩减比例: {reduction}%{note}"
             ))
+            self.master.after(0, lambda: self.progress.config(value=100))
+        
+        except JobCancelled:
+            raise
+        except Exception as e:
+            # except 块结束后 e 会被删除，延迟执行的回调只能引用已取出的消息
+            message = str(e)
+            self.master.after(0, lambda: messagebox.showerror("错误", f"压缩过程中发生意外错误: {message}"))
+
+    def compress_folder(self, quality, cancel_token, emit):
+        """批量压缩文件夹的处理函数，在任务线程中运行"""
+        try:
+            # 使用自定义输出路径或默认路径
+            if self.output_path and os.path.isdir(self.output_path):
+                output_dir = self.output_path
+            else:
+                parent_dir = os.path.dirname(os.path.normpath(self.selected_path))
+                folder_name = os.path.basename(os.path.normpath(self.selected_path))
+                output_dir = os.path.join(parent_dir, f"compressed_{folder_name}")
+                if not self.output_path:  # 如果输出路径为空
+                    self.master.after(0, lambda: messagebox.showinfo(
+                        "提示", f"未选择输出路径，将输出到: {output_dir}"))
             
-            # 重置压缩状态
-            self.is_compressing = False
-            self.compress_button.config(state=tk.NORMAL)
-            self.progress["value"] = 100
+            # 检查是否设置了目标大小
+            target_bytes = None
+            total_bytes = None
+            target_size_str = self.size_entry.get().strip()
+            if target_size_str:
+                try:
+                    target_size = float(target_size_str)
+                    unit = self.size_unit.get()
+                    size_bytes = int(target_size * 1024 if unit == "KB" else target_size * 1024 * 1024)
+                    if self.size_scope.get() == "总大小":
+                        total_bytes = size_bytes
+                    else:
+                        target_bytes = size_bytes
+                except ValueError:
+                    # 目标大小格式错误，使用默认质量压缩
+                    pass
+            
+            def on_progress(done, total, result):
+                emit({'type': 'file', 'done': done, 'total': total, 'result': result})
+
+            results = compress_folder(
+                self.selected_path, output_dir, quality,
+                resize_scale=self.resize_scale.get(),
+                grayscale=self.grayscale.get(),
+                reduce_colors=self.reduce_colors.get(),
+                extreme=self.extreme_compression.get(),
+                resize_method=self.get_resize_method(),
+                target_bytes=target_bytes,
+                total_bytes=total_bytes,
+                progress_callback=on_progress,
+                cancel_token=cancel_token)
+            if cancel_token.cancelled:
+                return results
+            
+            succeeded = [r for r in results if not r['error']]
+            failed = len(results) - len(succeeded)
+            passthrough = sum(1 for r in succeeded if r.get('passthrough'))
+            duplicates = sum(1 for r in succeeded if r.get('duplicate_of'))
+            original_size = sum(r['original_size'] for r in succeeded)
+            compressed_size = sum(r['compressed_size'] for r in succeeded)
+            reduction = 100 - int((compressed_size / original_size) * 100) if original_size else 0
+            # 目标大小或总预算没能满足时提示，PNG 输出的大小与质量无关
+            note = ""
+            over_target = sum(1 for r in succeeded if r.get('over_target'))
+            if over_target:
+                note += f"\n未能压缩到目标大小: {over_target} 个文件"
+            if total_bytes and compressed_size > total_bytes:
+                note += f"\n超出总大小预算: {format_size(compressed_size - total_bytes)}"
+            self.master.after(0, lambda: messagebox.showinfo(
+                "成功",
+                f"批量压缩完成!\n\n"
+                f"成功: {len(succeeded)} 个文件，失败: {failed} 个文件\n"
+                f"无法继续压缩、原样保留: {passthrough} 个文件\n"
+                f"重复文件（只压缩一次）: {duplicates} 个文件\n"
+                f"原始大小: {format_size(original_size)}\n"
+                f"压缩后大小: {format_size(compressed_size)}\n"
+                f"缩减比例: {reduction}%{note}"
+            ))
+            self.master.after(0, lambda: self.progress.config(value=100))
             
         except Exception as e:
-            self.master.after(0, lambda: messagebox.showerror("错误", f"压缩过程中发生意外错误: {str(e)}"))
-            self.is_compressing = False
-            self.compress_button.config(state=tk.NORMAL)
\ No newline at end of file
+            # except 块结束后 e 会被删除，延迟执行的回调只能引用已取出的消息
+            message = str(e)
+            self.master.after(0, lambda: messagebox.showerror("错误", f"压缩过程中发生意外错误: {message}"))
@@ -0,0 +1,337 @@
+"""
+监视文件夹：持续压缩上传目录中新出现或被修改的图片
+Linux 上通过 ctypes 使用 inotify，其他平台或 inotify 不可用时用 os.scandir 定期轮询
+文件大小和修改时间在稳定间隔内不再变化后才压缩，成批提交给工作进程池
+"""
+import ctypes
+import ctypes.util
+import errno
+import functools
+import os
+import select
+import signal
+import struct
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from core import (
+    BatchManifest, CompressionPlan, batch_output_path, batch_settings, compress_folder,
+    debounce, folder_palette, folder_params, iter_image_files, IMAGE_EXTENSIONS,
+    _compress_folder_job, _init_batch_worker,
+)
+
+# inotify 事件掩码，取值见 <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+# 写入过程中的 IN_MODIFY 也要记录：关闭事件可能因文件描述符被子进程继承而推迟，
+# 是否写入完成以大小和修改时间是否稳定为准
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+EVENT_HEADER = struct.Struct('iIII')
+
+class Inotify:
+    """
+    递归监视目录树的 inotify 封装，新建的子目录会自动加入监视
+    无法使用 inotify 时构造函数抛出 OSError
+    """
+    def __init__(self, folder_path, exclude=None):
+        library = ctypes.util.find_library('c')
+        if library is None:
+            raise OSError(errno.ENOSYS, "找不到 libc")
+        self._libc = ctypes.CDLL(library, use_errno=True)
+        if not hasattr(self._libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, "系统不支持 inotify")
+        self._libc.inotify_add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self.fd = self._libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 失败")
+        self.exclude = os.path.realpath(exclude) if exclude else None
+        self.directories = {}
+        try:
+            self.add_tree(folder_path)
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def add_tree(self, folder_path):
+        """监视目录及其所有子目录，返回目录中已有的图片路径"""
+        self._add(folder_path)
+        found = []
+        for root, dirs, files in os.walk(folder_path):
+            dirs[:] = [d for d in dirs if not self._excluded(os.path.join(root, d))]
+            for name in dirs:
+                self._add(os.path.join(root, name))
+            found.extend(os.path.join(root, name) for name in files
+                         if name.lower().endswith(IMAGE_EXTENSIONS))
+        return found
+
+    def _excluded(self, path):
+        return self.exclude is not None and os.path.realpath(path) == self.exclude
+
+    def _add(self, path):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            # 监视数量达到 fs.inotify.max_user_watches 时为 ENOSPC
+            raise OSError(ctypes.get_errno(), f"无法监视目录 {path}")
+        self.directories[wd] = path
+
+    def read(self, timeout):
+        """
+        等待最多 timeout 秒，返回 (图片路径列表, 是否需要全量扫描)
+        事件队列溢出时丢失了事件，需要重新扫描整个目录树
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return [], False
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return [], False
+        paths, overflow = [], False
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b'\0')
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self.directories.pop(wd, None)
+                continue
+            directory = self.directories.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, os.fsdecode(name))
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and not self._excluded(path):
+                    # 子目录在加入监视之前可能已经有文件写入
+                    try:
+                        paths.extend(self.add_tree(path))
+                    except OSError as e:
+                        print(f"监视目录 {path} 时出错: {e}", file=sys.stderr)
+            elif path.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(path)
+        # 同一文件的多次写入事件只保留一个
+        return list(dict.fromkeys(paths)), overflow
+
+    def close(self):
+        os.close(self.fd)
+
+class Poller:
+    """
+    没有 inotify 时的后备方案：每隔 interval 秒用 os.scandir 扫描目录树，
+    返回新出现或大小、修改时间有变化的图片
+    """
+    def __init__(self, folder_path, exclude=None, interval=1.0):
+        self.folder_path = folder_path
+        self.exclude = exclude
+        self.interval = interval
+        self.snapshot = self._scan()
+        self._next_scan = time.monotonic() + interval
+
+    def _scan(self):
+        snapshot = {}
+        for path in iter_image_files(self.folder_path, exclude=self.exclude):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+        return snapshot
+
+    def read(self, timeout):
+        delay = self._next_scan - time.monotonic()
+        if delay > timeout:
+            time.sleep(timeout)
+            return [], False
+        time.sleep(max(delay, 0))
+        self._next_scan = time.monotonic() + self.interval
+        snapshot = self._scan()
+        changed = [path for path, state in snapshot.items() if self.snapshot.get(path) != state]
+        self.snapshot = snapshot
+        return changed, False
+
+    def close(self):
+        pass
+
+def _ignore_interrupt():
+    """工作进程忽略 Ctrl+C，由主进程停止监视并等待已提交的文件完成；源文件映射不缓存，任务结束即关闭"""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    _init_batch_worker()
+
+def _file_state(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+class FolderWatcher:
+    """
+    监视 input_folder，把稳定下来的图片压缩到 output_folder，目录结构与 compress_folder 相同
+    每次文件事件都推迟一次处理，直到 settle 秒内没有新事件（最多推迟 max_wait 秒），
+    处理时文件的大小和修改时间在 settle 秒内未变化才提交，仍在写入的文件等待下一次处理
+    启动时先用 compress_folder 增量压缩已有的文件，之后的结果同样写入清单，重新启动时不会重复压缩
+    options 为 compress_folder 的压缩参数（quality、resize_scale 等，以及 shared_palette）
+    """
+    def __init__(self, input_folder, output_folder, settle=0.25, max_wait=1.0, poll_interval=1.0,
+                 use_inotify=True, max_workers=None, progress_callback=None, **options):
+        if os.path.realpath(input_folder) == os.path.realpath(output_folder):
+            raise ValueError("输出目录不能与监视的目录相同")
+        self.input_folder = input_folder
+        self.output_folder = output_folder
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.progress_callback = progress_callback
+        if options.pop('shared_palette', False) and options.get('palette') is None and (
+                options.get('reduce_colors') or options.get('extreme')):
+            options['palette'] = folder_palette(
+                input_folder, CompressionPlan(extreme=options.get('extreme', False)).colors,
+                options.get('quantizer', 'mediancut'), exclude=output_folder)
+        self.options = options
+        self.params = folder_params(**options)
+        self.settings = batch_settings(self.params)
+        # 等待稳定的文件：路径 -> (大小和修改时间, 最近一次变化的时间)
+        self._pending = {}
+        # 正在压缩的文件及提交时的状态，重复的事件不会再次提交同一内容；完成后移除，
+        # 之后的事件由清单判断是否需要重新压缩
+        self._submitted = {}
+        self._lock = threading.Lock()
+        self._executor = None
+        self._manifest = None
+        self._stopped = threading.Event()
+        self.schedule = debounce(settle, max_wait)(self._flush)
+
+    def notice(self, paths):
+        """记录有变化的文件，推迟到稳定后处理"""
+        now = time.monotonic()
+        with self._lock:
+            for path in paths:
+                state = _file_state(path)
+                if state is None:
+                    continue
+                previous = self._pending.get(path)
+                if previous is None or previous[0] != state:
+                    self._pending[path] = (state, now)
+        if paths:
+            self.schedule()
+
+    def _flush(self):
+        """提交已经稳定的文件，仍在变化的文件留待下一次处理"""
+        if self._stopped.is_set():
+            return
+        now = time.monotonic()
+        ready = []
+        with self._lock:
+            for path, (state, changed_at) in list(self._pending.items()):
+                current = _file_state(path)
+                if current is None:
+                    del self._pending[path]  # 文件已被删除或移走
+                elif current != state:
+                    self._pending[path] = (current, now)
+                elif now - changed_at >= self.settle * 0.9:  # 定时器可能略早触发
+                    del self._pending[path]
+                    if self._submitted.get(path) != current:
+                        self._submitted[path] = current
+                        ready.append((path, current))
+            waiting = bool(self._pending)
+        for path, state in ready:
+            output_path = batch_output_path(path, self.input_folder, self.output_folder)
+            try:
+                with self._lock:
+                    unchanged = self._manifest.lookup(path, self.settings)
+            except OSError:
+                self._forget(path, state)
+                continue
+            if unchanged:
+                self._forget(path, state)
+                continue  # 已经压缩过同样的内容
+            try:
+                future = self._executor.submit(
+                    _compress_folder_job, (path, output_path, self.params, None, False, True))
+            except RuntimeError:
+                return  # 已停止，进程池已关闭
+            future.add_done_callback(functools.partial(self._finished, path, state))
+        if waiting:
+            self.schedule()
+
+    def _forget(self, path, state):
+        """文件不再处于压缩中；压缩期间又提交了新内容时保留新的状态"""
+        with self._lock:
+            if self._submitted.get(path) == state:
+                del self._submitted[path]
+
+    def _finished(self, path, state, future):
+        self._forget(path, state)
+        if future.cancelled():
+            return
+        result = future.result()
+        with self._lock:
+            if not result['error']:
+                self._manifest.append(result, self.settings)
+        # 结果只交给回调，长时间监视时不在内存中累积
+        if self.progress_callback:
+            self.progress_callback(result)
+
+    def _open_source(self):
+        """优先使用 inotify，不可用时改为轮询"""
+        if self.use_inotify:
+            try:
+                return Inotify(self.input_folder, exclude=self.output_folder)
+            except (OSError, AttributeError) as e:
+                print(f"无法使用 inotify，改为每 {self.poll_interval} 秒轮询: {e}", file=sys.stderr)
+        return Poller(self.input_folder, exclude=self.output_folder, interval=self.poll_interval)
+
+    def run(self, cancel_token=None):
+        """
+        开始监视，直到 cancel_token 被取消或调用 stop
+        先建立监视再增量压缩已有文件，两者之间写入的文件也不会遗漏
+        """
+        def on_progress(done, total, result):
+            if self.progress_callback:
+                self.progress_callback(result)
+
+        source = self._open_source()
+        try:
+            compress_folder(self.input_folder, self.output_folder, max_workers=self.max_workers,
+                            progress_callback=on_progress, cancel_token=cancel_token, **self.options)
+            self._manifest = BatchManifest(self.input_folder, self.output_folder)
+            # 退出时等待已提交的文件完成，结果仍写入清单
+            with ProcessPoolExecutor(max_workers=self.max_workers, initializer=_ignore_interrupt) as executor:
+                self._executor = executor
+                while not self._stopped.is_set() and not (cancel_token is not None and cancel_token.cancelled):
+                    paths, overflow = source.read(0.2)
+                    if overflow:
+                        paths = list(iter_image_files(self.input_folder, exclude=self.output_folder))
+                    self.notice(paths)
+                self._stopped.set()
+                timer = getattr(self.schedule, 'timer', None)
+                if timer is not None:
+                    timer.cancel()
+        finally:
+            self._stopped.set()
+            source.close()
+            if self._manifest is not None:
+                with self._lock:
+                    self._manifest.close()
+
+    def stop(self):
+        self._stopped.set()
+
+def watch_folder(input_folder, output_folder, cancel_token=None, **kwargs):
+    """
+    监视文件夹并持续压缩，阻塞直到 cancel_token 被取消，每个文件的结果字典通过 progress_callback 传递
+    其余参数见 FolderWatcher
+    """
+    FolderWatcher(input_folder, output_folder, **kwargs).run(cancel_token)